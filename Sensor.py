@@ -6,50 +6,149 @@ July 13th, 2022
 The Sensor class allows a standard and easy to modify interface for interacting with the sensors, such as the dht temp
 and humidity sensor.
 
+Each sensor keeps track of its own health, so that a failing sensor doesn't cost time every loop:
+    - HEALTHY:    Good readings, polled every loop
+    - DEGRADED:   A few errors in a row (the DHT22 fails now and then), still polled every loop
+    - BACKOFF:    SENSOR_DEGRADED_ERROR_LIMIT errors in a row, only polled after a wait that doubles every failure
+    - OFFLINE:    SENSOR_OFFLINE_ERROR_LIMIT errors in a row, only polled every SENSOR_BACKOFF_MAX_SECONDS
+    - RECOVERING: Got a good reading while in BACKOFF/OFFLINE, polled every loop until SENSOR_RECOVERY_SUCCESS_COUNT
+                  good readings in a row, any error puts it back into BACKOFF
+
 """
+import time
 import crab_library
 
 
+HEALTHY = "HEALTHY"
+DEGRADED = "DEGRADED"
+BACKOFF = "BACKOFF"
+OFFLINE = "OFFLINE"
+RECOVERING = "RECOVERING"
+
+
 class Sensor:
-    def __init__(self, dht_sensor, sensor_number):
+    def __init__(self, dht_sensor, sensor_number, clock=time.monotonic):
         self.dht_sensor = dht_sensor
         self.tempeture_f = 0
         self.tempeture_c = 0
         self.humidity = 0
         self.sensor_number = sensor_number
-        self.status = "ONLINE"
+        self.clock = clock
+
+        self.status = HEALTHY
+        # Errors in a row
+        self.error_flag = 0
+        # Total errors by the type of error, i.e. {"RuntimeError": 12}
+        self.error_counts = {}
+        # True if the last get_temp_and_humid() got a new reading
+        self.fresh = False
+        self.last_good_time = None
+        self.backoff_seconds = 0
+        self.next_poll_time = 0
+        self.recovery_count = 0
+
+    def should_poll(self):
+        """
+        :return: True if the sensor is due to be read, False if it is waiting out a backoff
+        """
+        return self.clock() >= self.next_poll_time
+
+    def staleness_seconds(self):
+        """
+        :return: How many seconds old the last good reading is, None if there has never been one
+        """
+        if self.last_good_time is None:
+            return None
+        return self.clock() - self.last_good_time
+
+    def _set_status(self, status):
+        if status != self.status:
+            crab_library.print_log(f"SENSOR-{self.sensor_number}: {self.status} -> {status}", 1)
+            self.status = status
+
+    def _record_success(self):
         self.error_flag = 0
+        if self.status in (BACKOFF, OFFLINE):
+            self.recovery_count = 0
+            self._set_status(RECOVERING)
+
+        if self.status == RECOVERING:
+            self.recovery_count = self.recovery_count + 1
+            if self.recovery_count >= crab_library.SENSOR_RECOVERY_SUCCESS_COUNT:
+                self._set_status(HEALTHY)
+        else:
+            self._set_status(HEALTHY)
+
+        if self.status == HEALTHY:
+            self.backoff_seconds = 0
+        self.next_poll_time = 0
+
+    def _record_error(self, error):
+        error_type = type(error).__name__
+        self.error_counts[error_type] = self.error_counts.get(error_type, 0) + 1
+        self.error_flag = self.error_flag + 1
+
+        if self.error_flag >= crab_library.SENSOR_OFFLINE_ERROR_LIMIT:
+            self.backoff_seconds = crab_library.SENSOR_BACKOFF_MAX_SECONDS
+            self._set_status(OFFLINE)
+        elif self.error_flag >= crab_library.SENSOR_DEGRADED_ERROR_LIMIT or self.status == RECOVERING:
+            self.backoff_seconds = min(max(self.backoff_seconds * 2, crab_library.SENSOR_BACKOFF_INITIAL_SECONDS),
+                                       crab_library.SENSOR_BACKOFF_MAX_SECONDS)
+            self._set_status(BACKOFF)
+        else:
+            self._set_status(DEGRADED)
+
+        if self.status in (BACKOFF, OFFLINE):
+            self.next_poll_time = self.clock() + self.backoff_seconds
 
     def get_temp_and_humid(self):
         """
-        Gets the temperature and humidity values from the selected dhtSensor.
+        Gets the temperature and humidity values from the selected dhtSensor. If the sensor is waiting out a backoff, it
+        is not read at all.
+
+        The humidity/tempeture values are only updated on a good reading, so they always hold the last good reading,
+        use fresh and staleness_seconds() to tell how old it is.
 
         :return: returns the humidity and temp readings from the sensor
                  returns "err, err" so that the values can still be recorded in the logs for easier debugging
         """
+        self.fresh = False
+        if not self.should_poll():
+            return "err", "err"
+
         try:
-            self.humidity = self.dht_sensor.humidity
-            self.tempeture_c = self.dht_sensor.temperature
-            # Fahrenheit conversion
-            self.tempeture_f = (self.tempeture_c * 9.0 / 5.0 + 32.0)
-            self.status = "ONLINE"
-            self.error_flag = 0
-            return self.humidity, self.tempeture_f
-        except RuntimeError:
-            crab_library.print_log(f": SENSOR-ERROR-{self.sensor_number}: Issue getting values from temp/humid sensor {self.sensor_number}", 0)
-            # Pass these strings so its easier to debug later on
-            # NOTE, may just change to have last value instead
-            self.error_flag = self.error_flag + 1
-            self.status = "ONLINE-ERROR"
-            # If cant get value 10 times in a row, then sensor most likely offline
-            if self.error_flag >= 50:
-                self.status = "OFFLINE"
+            humidity = self.dht_sensor.humidity
+            tempeture_c = self.dht_sensor.temperature
+            if humidity is None or tempeture_c is None:
+                raise RuntimeError("No value returned")
+        except Exception as e:
+            crab_library.print_log(f": SENSOR-ERROR-{self.sensor_number}: {type(e).__name__} getting values from temp/humid sensor {self.sensor_number}: {e}", 0)
+            self._record_error(e)
             return "err", "err"
-        except:
-            self.error_flag = self.error_flag + 1
-            self.status = "OTHER-ERROR"
-            # If cant get value 10 times in a row, then sensor most likely offline
-            if self.error_flag >= 50:
-                self.status = "OFFLINE"
+
+        self.humidity = humidity
+        self.tempeture_c = tempeture_c
+        # Fahrenheit conversion
+        self.tempeture_f = (self.tempeture_c * 9.0 / 5.0 + 32.0)
+        self.fresh = True
+        self.last_good_time = self.clock()
+        self._record_success()
+        return self.humidity, self.tempeture_f
+
+    def log_values(self):
+        """
+        :return: The humidity and temperature to write in the logs, "err, err" if there was no new reading this loop,
+                 so an old reading held from before a failure or backoff is never logged as if it were new
+        """
+        if not self.fresh:
             return "err", "err"
+        return self.humidity, self.tempeture_f
 
+    def health_summary(self):
+        """
+        :return: One line summary of the sensor's health for the logs
+        """
+        staleness = self.staleness_seconds()
+        staleness = "never" if staleness is None else f"{staleness:.0f}s"
+        return (f"SENSOR-{self.sensor_number}: {self.status}, last good reading {staleness} ago, "
+                f"errors in a row: {self.error_flag}, errors: {self.error_counts}")
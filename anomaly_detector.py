@@ -0,0 +1,178 @@
+"""
+Joel Yuhas
+Raspberry-Pi/Hermit Crab project
+
+-------------------------------------------------------------------------------------
+anomaly_detector.py
+-------------------------------------------------------------------------------------
+
+Watches the readings from the temp/humid sensors for signs of a sensor drifting or failing, before it starts
+returning "err".
+
+Fed one set of readings every loop by temp_humid_capture.py. Everything is kept as running values (no history of
+readings), so it takes the same small amount of memory and time every loop no matter how long it runs.
+
+Checks:
+    - DRIFT: The difference between the two sensors, either past the max difference, or with its recent average
+             (exponential moving average) ANOMALY_DRIFT_SIGMAS standard deviations away from the long running average
+             (Welford's running mean and variance)
+    - JUMP:  A sensor's reading changing faster than is believable between two readings
+    - STUCK: A sensor returning the exact same temperature and humidity ANOMALY_STUCK_SAMPLES times in a row
+
+Alerts are passed to the alert function (print_log and the status LEDs in temp_humid_capture.py), and the same alert is
+only raised again after ANOMALY_ALERT_COOLDOWN_SECONDS.
+
+"""
+import math
+import time
+import crab_library
+
+
+"""
+Weight of each new reading in the recent average of the sensor difference, 0.02 is roughly the last 50 readings
+"""
+RECENT_AVERAGE_WEIGHT = 0.02
+
+
+class RunningStats:
+    """
+    Running mean and variance (Welford's method), updated one value at a time without keeping the values
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        self.count = self.count + 1
+        delta = value - self.mean
+        self.mean = self.mean + delta / self.count
+        self.m2 = self.m2 + delta * (value - self.mean)
+
+    def variance(self):
+        if self.count < 2:
+            return 0.0
+        return self.m2 / (self.count - 1)
+
+    def std(self):
+        return math.sqrt(self.variance())
+
+
+class DifferenceTracker:
+    """
+    Tracks the difference between the two sensors for one value (temperature or humidity)
+    """
+    def __init__(self, name, max_difference):
+        self.name = name
+        self.max_difference = max_difference
+        self.stats = RunningStats()
+        self.recent = None
+
+    def update(self, difference):
+        """
+        :return: The alert message if the difference looks like drift, otherwise None
+        """
+        self.recent = difference if self.recent is None else (
+            self.recent + RECENT_AVERAGE_WEIGHT * (difference - self.recent))
+        self.stats.add(difference)
+
+        if abs(self.recent) > self.max_difference:
+            return (f"DRIFT: sensors {self.name} differ by {self.recent:.2f} on average, more than "
+                    f"{self.max_difference}")
+        if self.stats.count >= crab_library.ANOMALY_WARMUP_SAMPLES:
+            # The sensors read in steps (0.1%, 0.18F), so the std can be tiny, don't go below a quarter of the max
+            limit = max(crab_library.ANOMALY_DRIFT_SIGMAS * self.stats.std(), self.max_difference / 4)
+            if abs(self.recent - self.stats.mean) > limit:
+                return (f"DRIFT: sensors {self.name} difference moved to {self.recent:.2f}, normally "
+                        f"{self.stats.mean:.2f} +/- {self.stats.std():.2f}")
+        return None
+
+
+class SensorTracker:
+    """
+    Tracks one sensor's rate of change and how long its readings have been the same
+    """
+    def __init__(self, sensor_number):
+        self.sensor_number = sensor_number
+        self.last_time = None
+        self.last_values = None
+        self.same_count = 0
+
+    def update(self, now, temperature, humidity):
+        """
+        :return: List of alert messages
+        """
+        alerts = []
+        if self.last_values is not None and now > self.last_time:
+            seconds = now - self.last_time
+            temperature_rate = (temperature - self.last_values[0]) / seconds
+            humidity_rate = (humidity - self.last_values[1]) / seconds
+            if abs(temperature_rate) > crab_library.ANOMALY_MAX_TEMP_RATE_F:
+                alerts.append(f"JUMP: sensor {self.sensor_number} temperature {self.last_values[0]} -> {temperature} "
+                              f"in {seconds:.0f}s")
+            if abs(humidity_rate) > crab_library.ANOMALY_MAX_HUMID_RATE:
+                alerts.append(f"JUMP: sensor {self.sensor_number} humidity {self.last_values[1]} -> {humidity} "
+                              f"in {seconds:.0f}s")
+
+        if self.last_values == (temperature, humidity):
+            self.same_count = self.same_count + 1
+            if self.same_count >= crab_library.ANOMALY_STUCK_SAMPLES:
+                alerts.append(f"STUCK: sensor {self.sensor_number} has read {temperature}F {humidity}% "
+                              f"{self.same_count} times in a row")
+        else:
+            self.same_count = 0
+
+        self.last_time = now
+        self.last_values = (temperature, humidity)
+        return alerts
+
+
+class AnomalyDetector:
+    def __init__(self, alert_function, clock=time.monotonic):
+        """
+        :param alert_function: Called with the message of each alert
+        :param clock: Function returning the current time in seconds
+        """
+        self.alert_function = alert_function
+        self.clock = clock
+        self.temperature_difference = DifferenceTracker("temperature", crab_library.ANOMALY_MAX_TEMP_DIFFERENCE_F)
+        self.humidity_difference = DifferenceTracker("humidity", crab_library.ANOMALY_MAX_HUMID_DIFFERENCE)
+        self.sensor_trackers = {}
+        # Alert type and sensor -> time last raised
+        self.last_alert_times = {}
+
+    def update(self, sensor_list):
+        """
+        Checks the latest readings. Only sensors with a new reading this loop (sensor.fresh) are used.
+
+        :param sensor_list: The Sensor objects
+        :return: The alerts raised
+        """
+        now = self.clock()
+        alerts = []
+        fresh = [sensor for sensor in sensor_list if sensor.fresh]
+        for sensor in fresh:
+            tracker = self.sensor_trackers.get(sensor.sensor_number)
+            if tracker is None:
+                tracker = self.sensor_trackers[sensor.sensor_number] = SensorTracker(sensor.sensor_number)
+            alerts.extend(tracker.update(now, sensor.tempeture_f, sensor.humidity))
+
+        # The difference is only meaningful when both sensors were read this loop, and a reading that jumped is left
+        # out so a single glitch doesn't throw off the running stats
+        if len(fresh) == 2 and not any(alert.startswith("JUMP") for alert in alerts):
+            alerts.append(self.temperature_difference.update(fresh[0].tempeture_f - fresh[1].tempeture_f))
+            alerts.append(self.humidity_difference.update(fresh[0].humidity - fresh[1].humidity))
+
+        raised = []
+        for alert in alerts:
+            if alert is None:
+                continue
+            # "JUMP: sensor 1 temperature ..." -> "JUMP: sensor 1 temperature", so each kind of alert has its own cooldown
+            key = " ".join(alert.split(" ")[:4])
+            last_time = self.last_alert_times.get(key)
+            if last_time is not None and now - last_time < crab_library.ANOMALY_ALERT_COOLDOWN_SECONDS:
+                continue
+            self.last_alert_times[key] = now
+            self.alert_function(alert)
+            raised.append(alert)
+        return raised
@@ -0,0 +1,461 @@
+"""
+Joel Yuhas
+Raspberry-Pi/Hermit Crab project
+
+-------------------------------------------------------------------------------------
+benchmark.py
+-------------------------------------------------------------------------------------
+
+Times the storage, log reading, dashboard and video rendering code on generated data, so changes can be checked for
+being faster or slower. Runs on any computer, no Pi, sensors or USB drive needed.
+
+Generated data (seeded, so every run gets the same data):
+    - Several days of temp/humid logs, half in the original 5 value format and half in the current 7 value format,
+      with some "err" readings and spool gap lines mixed in
+    - A captures directory with thousands of hour folders, and a year of daily logs, for check_space to clean up (also
+      packed into container files, see capture_container.py)
+    - A folder of 1280x720 jpegs for images_to_video.py (skipped if opencv is not installed)
+
+Results are written as JSON. If a baseline (a results file from an earlier run) is given, each timing is compared
+against it, and the program exits with 1 if anything is more than --tolerance slower.
+
+Example:
+    python3 benchmark.py --output baseline.json
+    ... make changes ...
+    python3 benchmark.py --output results.json --baseline baseline.json
+
+"""
+import argparse
+import contextlib
+import io
+import json
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import capture_container
+import crab_library
+import dashboard
+import log_store
+
+from datetime import datetime, timedelta
+from pathlib import Path
+
+
+SEED = 2022
+
+"""
+Sizes of the generated data, "quick" is for checking the benchmarks themselves work
+"""
+SIZES = {
+    "full": {"log_days": 7, "hour_folders": 5000, "daily_logs": 365, "frames": 60},
+    "quick": {"log_days": 2, "hour_folders": 500, "daily_logs": 60, "frames": 10},
+}
+
+# The generated pictures are in the first hour of the generated logs, so the overlay has readings to match
+FRAMES_HOUR_FOLDER = "2022070100"
+
+READINGS_PER_DAY = 24 * 60 * 60 // crab_library.TEMP_HUMID_WAIT_INTERVAL_SECONDS
+
+
+@contextlib.contextmanager
+def patched_library(**values):
+    """
+    Temporarily changes crab_library constants (directories, thresholds), so check_space etc. run on the generated data
+    """
+    old_values = {name: getattr(crab_library, name) for name in values}
+    for name, value in values.items():
+        setattr(crab_library, name, value)
+    try:
+        yield
+    finally:
+        for name, value in old_values.items():
+            setattr(crab_library, name, value)
+
+
+def generate_day_log(path, day, rng, current_format):
+    """
+    Writes one day of readings, a reading every TEMP_HUMID_WAIT_INTERVAL_SECONDS, as a random walk around the middle of
+    the ideal ranges
+    """
+    temperature = 76.0
+    humidity = 78.0
+    fan_status = "off"
+    timestamp = datetime.strptime(day, '%Y%m%d')
+    with open(path, "w") as log_file:
+        for _ in range(READINGS_PER_DAY):
+            timestamp = timestamp + timedelta(seconds=crab_library.TEMP_HUMID_WAIT_INTERVAL_SECONDS)
+            temperature = min(max(temperature + rng.choice((-0.18, 0, 0, 0.18)), 68), 86)
+            humidity = min(max(humidity + rng.choice((-0.1, 0, 0, 0.1)), 60), 95)
+            fan_status = "on" if humidity > crab_library.HUMIDITY_UPPER_LIMIT else (
+                "off" if humidity < crab_library.HUMIDITY_LOWER_LIMIT else fan_status)
+
+            if rng.random() < 0.0005:
+                log_file.write(f"{timestamp.strftime('%Y-%m-%d-%H:%M:%S')}, gap, {rng.randint(1, 50)}\n")
+                continue
+
+            values = [round(humidity, 1), round(temperature, 2),
+                      round(humidity + rng.uniform(-1, 1), 1), round(temperature + rng.uniform(-0.4, 0.4), 2)]
+            if rng.random() < 0.01:
+                values[0:2] = ["err", "err"]
+            line = log_store.format_line(timestamp, *values, fan_status, "off")
+            if not current_format:
+                line = line.rsplit(", ", 2)[0] + "\n"
+            log_file.write(line)
+
+
+def generate_logs(directory, days, rng):
+    directory.mkdir(parents=True)
+    first_day = datetime(2022, 7, 1)
+    for i in range(days):
+        day = (first_day + timedelta(days=i)).strftime('%Y%m%d')
+        generate_day_log(directory / (day + '.txt'), day, rng, current_format=i >= days // 2)
+
+
+def generate_capture_tree(directory, hour_folders, daily_logs):
+    """
+    Hour folders, each with a few small files in them, plus short daily logs
+    """
+    (directory / 'captures').mkdir(parents=True)
+    (directory / 'temp-humid-logs').mkdir()
+    hour = datetime(2022, 1, 1)
+    for _ in range(hour_folders):
+        hour_directory = directory / 'captures' / hour.strftime('%Y%m%d%H')
+        hour_directory.mkdir()
+        for minute in range(3):
+            (hour_directory / f"image_{minute:02d}00.jpg").write_bytes(b"\xff\xd8" + bytes(1024))
+        hour = hour + timedelta(hours=1)
+
+    day = datetime(2022, 1, 1)
+    for _ in range(daily_logs):
+        line = log_store.format_line(day, 78.1, 76.28, 77.9, 76.46, "off", "off")
+        (directory / 'temp-humid-logs' / day.strftime('%Y%m%d.txt')).write_text(line)
+        day = day + timedelta(days=1)
+
+
+def generate_frames(directory, frames, rng):
+    """
+    1280x720 jpegs of a few moving shapes on a noisy background, so the jpegs are close to the real size
+    """
+    import cv2
+    import numpy
+
+    directory.mkdir(parents=True)
+    noise = numpy.random.default_rng(SEED)
+    for i in range(frames):
+        image = noise.integers(40, 90, (720, 1280, 3), dtype=numpy.uint8)
+        for crab in range(3):
+            center = (int(200 + 300 * crab + 10 * i), int(360 + rng.randint(-20, 20)))
+            cv2.circle(image, center, 60, (30, 80, 160), -1)
+        cv2.imwrite(str(directory / f"image_{i // 30:02d}{(i % 30) * 2:02d}.jpg"), image)
+
+
+"""
+Benchmarks
+
+Each one has a setup (not timed) that gets a fresh working directory and the shared generated data, and a run (timed)
+which returns how many items were processed.
+"""
+
+
+def setup_log_write(work, data):
+    return work / 'log.txt'
+
+
+def run_log_write(path):
+    timestamp = datetime(2022, 7, 1)
+    step = timedelta(seconds=crab_library.TEMP_HUMID_WAIT_INTERVAL_SECONDS)
+    with open(path, "a") as log_file:
+        for _ in range(READINGS_PER_DAY):
+            timestamp = timestamp + step
+            log_file.write(log_store.format_line(timestamp, 78.1, 76.28, 77.9, 76.46, "off", "off"))
+    return READINGS_PER_DAY
+
+
+def setup_check_space(work, data):
+    shutil.copytree(data / 'tree', work / 'usb')
+    return work / 'usb'
+
+
+def setup_check_space_containers(work, data):
+    usb_directory = setup_check_space(work, data)
+    for hour_directory in capture_container.hour_sources(usb_directory / 'captures'):
+        capture_container.pack_folder(hour_directory, remove=True)
+    return usb_directory
+
+
+def run_check_space(usb_directory, type):
+    with patched_library(USB_DIRECTORY=usb_directory, CAMERA_PARENT_LOCATION=usb_directory / 'captures',
+                         TEMP_HUMID_PARENT_LOCATION=usb_directory / 'temp-humid-logs',
+                         SPACE_THRESHOLD_KB=2 ** 62):
+        for _ in range(10):
+            crab_library.check_space(type)
+    return 10
+
+
+def setup_plain_logs(work, data):
+    return data / 'logs'
+
+
+def setup_compressed_logs(work, data):
+    shutil.copytree(data / 'logs', work / 'logs')
+    with patched_library(DEBUG_LOG_TOGGLE_THRESHOLD=-1):
+        log_store.compress_closed_logs(work / 'logs')
+    return work / 'logs'
+
+
+def run_aggregate(directory):
+    """
+    Daily min/mean/max of the averaged temperature, mean humidity, fan on count and error count, the kind of work
+    anything reading the logs does
+    """
+    days = {}
+    count = 0
+    for record in log_store.iter_records(directory):
+        count = count + 1
+        day = days.setdefault(record.timestamp.date(), {"temps": [0, 0, 1000, -1000], "humid": [0, 0], "fan": 0,
+                                                        "errors": 0})
+        if record.gap is not None:
+            continue
+        if record.temperature_1 is None or record.temperature_2 is None:
+            day["errors"] = day["errors"] + 1
+            continue
+        temperature = (record.temperature_1 + record.temperature_2) / 2
+        temps = day["temps"]
+        temps[0] = temps[0] + temperature
+        temps[1] = temps[1] + 1
+        temps[2] = min(temps[2], temperature)
+        temps[3] = max(temps[3], temperature)
+        day["humid"][0] = day["humid"][0] + (record.humidity_1 + record.humidity_2) / 2
+        day["humid"][1] = day["humid"][1] + 1
+        if record.fan_status == "on":
+            day["fan"] = day["fan"] + 1
+    return count
+
+
+def run_range_queries(directory):
+    """
+    One 5 minute range out of every hour of every day
+    """
+    count = 0
+    for day in log_store.log_days(directory):
+        start_of_day = datetime.strptime(day, '%Y%m%d')
+        for hour in range(24):
+            start = start_of_day + timedelta(hours=hour, minutes=20)
+            count = count + sum(1 for _ in log_store.iter_records(directory, start, start + timedelta(minutes=5)))
+    return count
+
+
+def setup_compress(work, data):
+    shutil.copytree(data / 'logs', work / 'logs')
+    return work / 'logs'
+
+
+def run_compress(directory):
+    with patched_library(DEBUG_LOG_TOGGLE_THRESHOLD=-1):
+        old_pause = log_store.COMPRESSION_BLOCK_PAUSE_SECONDS
+        log_store.COMPRESSION_BLOCK_PAUSE_SECONDS = 0
+        try:
+            return log_store.compress_closed_logs(directory)
+        finally:
+            log_store.COMPRESSION_BLOCK_PAUSE_SECONDS = old_pause
+
+
+def setup_render(work, data):
+    return data / 'frames' / FRAMES_HOUR_FOLDER, work / 'video.avi', None
+
+
+def setup_render_overlay(work, data):
+    return data / 'frames' / FRAMES_HOUR_FOLDER, work / 'video.avi', data / 'logs'
+
+
+def setup_render_container(work, data):
+    hour_directory = work / FRAMES_HOUR_FOLDER
+    shutil.copytree(data / 'frames' / FRAMES_HOUR_FOLDER, hour_directory)
+    capture_container.pack_folder(hour_directory, remove=True)
+    return capture_container.container_path(hour_directory), work / 'video.avi', None
+
+
+def run_render(paths):
+    import images_to_video
+
+    frame_directory, output_path, log_directory = paths
+    with contextlib.redirect_stdout(io.StringIO()):
+        images_to_video.render_video(str(frame_directory) + "/", str(output_path), log_directory)
+    with capture_container.open_hour(frame_directory) as pictures:
+        return len(pictures)
+
+
+def setup_dashboard(work, data):
+    return data / 'logs', work / 'dashboard'
+
+
+def setup_dashboard_incremental(work, data):
+    # Summaries already made, then one more reading in the last day, as it is every run on the pi
+    shutil.copytree(data / 'logs', work / 'logs')
+    dashboard.update_summaries(work / 'logs', work / 'dashboard')
+    last_day = log_store.log_days(work / 'logs')[-1]
+    with open(work / 'logs' / (last_day + ".txt"), "a") as log_file:
+        log_file.write(log_store.format_line(datetime.strptime(last_day, '%Y%m%d') + timedelta(hours=23, minutes=59),
+                                             78.1, 76.28, 77.9, 76.46, "off", "off"))
+    return work / 'logs', work / 'dashboard'
+
+
+def run_dashboard(paths):
+    log_directory, dashboard_directory = paths
+    summaries, _ = dashboard.update_summaries(log_directory, dashboard_directory)
+    dashboard.render_page(summaries, [], None)
+    return len(summaries)
+
+
+BENCHMARKS = [
+    ("log_write", setup_log_write, run_log_write, False),
+    ("check_space_captures", setup_check_space,
+     lambda usb: run_check_space(usb, crab_library.CAMERA_TYPE_FLAG), False),
+    ("check_space_containers", setup_check_space_containers,
+     lambda usb: run_check_space(usb, crab_library.CAMERA_TYPE_FLAG), False),
+    ("check_space_logs", setup_check_space,
+     lambda usb: run_check_space(usb, crab_library.TEMP_HUMID_TYPE_FLAG), False),
+    ("aggregate_plain_logs", setup_plain_logs, run_aggregate, False),
+    ("aggregate_compressed_logs", setup_compressed_logs, run_aggregate, False),
+    ("range_queries_plain_logs", setup_plain_logs, run_range_queries, False),
+    ("range_queries_compressed_logs", setup_compressed_logs, run_range_queries, False),
+    ("compress_closed_logs", setup_compress, run_compress, False),
+    ("dashboard_full", setup_dashboard, run_dashboard, False),
+    ("dashboard_incremental", setup_dashboard_incremental, run_dashboard, False),
+    ("images_to_video_render", setup_render, run_render, True),
+    ("images_to_video_render_overlay", setup_render_overlay, run_render, True),
+    ("images_to_video_render_container", setup_render_container, run_render, True),
+]
+
+
+def opencv_available():
+    try:
+        import cv2
+        import numpy
+        return True
+    except ImportError:
+        return False
+
+
+def run_benchmarks(size, repeats, selected=None):
+    """
+    Generates the data and runs every benchmark repeats times, keeping the fastest time of each
+
+    :param size: One of the SIZES names
+    :param repeats: How many times to run each benchmark
+    :param selected: If given, only run the benchmarks with these names
+    :return: Dictionary of the results by benchmark name
+    """
+    rng = random.Random(SEED)
+    sizes = SIZES[size]
+    has_opencv = opencv_available()
+    results = {}
+
+    with tempfile.TemporaryDirectory(prefix="hermitcrab-benchmark-") as temp_directory:
+        data = Path(temp_directory) / 'data'
+        generate_logs(data / 'logs', sizes["log_days"], rng)
+        generate_capture_tree(data / 'tree', sizes["hour_folders"], sizes["daily_logs"])
+        if has_opencv:
+            generate_frames(data / 'frames' / FRAMES_HOUR_FOLDER, sizes["frames"], rng)
+
+        for name, setup, run, needs_opencv in BENCHMARKS:
+            if selected and name not in selected:
+                continue
+            if needs_opencv and not has_opencv:
+                results[name] = {"skipped": "opencv not installed"}
+                print(f"{name:32} skipped (opencv not installed)")
+                continue
+
+            times = []
+            for i in range(repeats):
+                work = Path(temp_directory) / f"{name}-{i}"
+                work.mkdir()
+                state = setup(work, data)
+                with patched_library(DEBUG_LOG_TOGGLE_THRESHOLD=-1):
+                    start = time.perf_counter()
+                    items = run(state)
+                    times.append(time.perf_counter() - start)
+                shutil.rmtree(work)
+
+            results[name] = {
+                "seconds": min(times),
+                "all_seconds": times,
+                "items": items,
+                "microseconds_per_item": min(times) / items * 1e6 if items else None,
+            }
+            print(f"{name:32} {min(times):9.4f}s  ({items} items)")
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares the results against a baseline
+
+    :return: list of the names of the benchmarks that got more than tolerance slower
+    """
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get("results", {}).get(name, {})
+        if "seconds" not in result or "seconds" not in old:
+            continue
+        ratio = result["seconds"] / old["seconds"]
+        result["baseline_seconds"] = old["seconds"]
+        result["ratio"] = ratio
+        flag = ""
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:32} {old['seconds']:9.4f}s -> {result['seconds']:9.4f}s  x{ratio:.2f}{flag}")
+    return regressions
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", type=Path, default=Path("benchmark_results.json"),
+                        help="Where to write the JSON results")
+    parser.add_argument("--baseline", type=Path, help="Results from an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="How much slower than the baseline counts as a regression (0.25 = 25%%)")
+    parser.add_argument("--repeats", type=int, default=3, help="Times to run each benchmark, the fastest is kept")
+    parser.add_argument("--size", choices=SIZES, default="full", help="Size of the generated data")
+    parser.add_argument("--only", nargs="+", help="Only run these benchmarks")
+    return parser.parse_args()
+
+
+def main(args):
+    results = run_benchmarks(args.size, args.repeats, args.only)
+    output = {
+        "created": datetime.today().strftime('%Y-%m-%d-%H:%M:%S'),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "size": args.size,
+        "repeats": args.repeats,
+        "results": results,
+    }
+
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        print("----------------------------")
+        regressions = compare(results, baseline, args.tolerance)
+        output["baseline"] = str(args.baseline)
+        output["regressions"] = regressions
+
+    with open(args.output, "w") as output_file:
+        json.dump(output, output_file, indent=2)
+    print(f"Results written to {args.output}")
+
+    if regressions:
+        print(f"Slower than the baseline: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(arg_parser()))
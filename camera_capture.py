@@ -13,24 +13,40 @@ This loop will do the following:
     - Ensure provided USB drive is available
     - Ensure all required folders are present or created in directory
     - Take a picture every WAIT_INTERVAL_SECONDS_PICTURE seconds
-    - Save that picture in the required directory
+    - Save that picture in the required directory, written in batches from a separate thread if CAMERA_STAGED_WRITES
+      (see staged_writer.py)
     - If the directory becomes too full, delete CAPTURE_HOURS_TO_CLEAR worth of folders
+    - If the USB drive is unavailable, hold the pictures in the spool (see spool.py) until it is back
+    - If CAMERA_VIDEO_RECORDER, keep recording video into memory and save clips around motion and climate events (see
+      video_recorder.py)
+
+On Ctrl+C or kill (SIGTERM), any video clip is finished, the pictures still queued for the staged writer are written and
+the hour's container is closed before exiting.
 
 Directory layout/methodology:
 - In the USB drive, all pictures are stored in the /captures/ directory, in a sub directory that is the date to the hour
 - This sub-directory will have all photos taken within that hour, and then will increment to the next hour subdirectory
   after the hour has expired
+- If CAMERA_CONTAINER_FILES, the photos for the hour are instead added to a single "<date to the hour>.crab" file in
+  /captures/ (see capture_container.py)
 
 
 """
+import io
+import signal
+import sys
 import time
 import crab_library
 
 from picamera import PiCamera
+from capture_container import HourlyContainers
+from spool import FrameSpool
+from staged_writer import StagedWriter
+from video_recorder import CircularRecorder
 from datetime import datetime
 
 
-def picture_capture(input_camera, save_directory, interval_time):
+def picture_capture(input_camera, save_directory, interval_time, use_video_port=False, containers=None):
     """
     Method used to capture images using the PiCamera and the raspberry pi camera. These pictures are then stitched
     together into a video using the "images_to_video" program. Each folder contains an hours worth of pictures
@@ -38,21 +54,78 @@ def picture_capture(input_camera, save_directory, interval_time):
     :param input_camera: PiCamera object that's been initialized pi camera
     :param save_directory: The directory to save the images
     :param interval_time: how much time to wait between camera captures
+    :param use_video_port: True to capture from the video port, needed while the video recorder is recording
+    :param containers: HourlyContainers to add the picture to, None to save it as its own file
     :return: the name of the picture that was generated (for recording purposes)
     """
     # Picture capture
-    picture_number = 'image_' + str(datetime.today().strftime('%M%S') + '.jpg')
-    input_camera.capture(str(save_directory / picture_number))
+    now = datetime.today()
+    picture_number = 'image_' + str(now.strftime('%M%S') + '.jpg')
+    if containers is not None:
+        stream = io.BytesIO()
+        input_camera.capture(stream, format='jpeg', use_video_port=use_video_port)
+        containers.add(save_directory, picture_number, stream.getvalue(), now)
+    else:
+        input_camera.capture(str(save_directory / picture_number), use_video_port=use_video_port)
+    time.sleep(interval_time)
+    return picture_number
+
+
+def spool_picture_capture(input_camera, frame_spool, interval_time, use_video_port=False):
+    """
+    Same as picture_capture, but used while the USB drive is unavailable. The picture is captured into memory and held
+    in the frame spool until the drive is back.
+
+    :param input_camera: PiCamera object that's been initialized pi camera
+    :param frame_spool: FrameSpool to hold the picture in
+    :param interval_time: how much time to wait between camera captures
+    :param use_video_port: True to capture from the video port, needed while the video recorder is recording
+    :return: the name of the picture that was generated (for recording purposes)
+    """
+    now = datetime.today()
+    picture_number = 'image_' + str(now.strftime('%M%S') + '.jpg')
+    stream = io.BytesIO()
+    input_camera.capture(stream, format='jpeg', use_video_port=use_video_port)
+    frame_spool.add(now.strftime('%Y%m%d%H'), picture_number, stream.getvalue())
     time.sleep(interval_time)
     return picture_number
 
 
+def staged_picture_capture(input_camera, staged_writer, frame_spool, save_directory, interval_time, start_time,
+                           use_video_port=False):
+    """
+    Same as picture_capture, but the picture is captured into memory and written to the USB drive by the staged writer
+    (see staged_writer.py). If the writer's queue is full, the picture goes in the frame spool instead.
+
+    The wait is counted from start_time, the start of the loop, so the time between pictures stays the same no matter
+    how long the capture took.
+
+    :param input_camera: PiCamera object that's been initialized pi camera
+    :param staged_writer: StagedWriter that writes the pictures
+    :param frame_spool: FrameSpool for pictures the writer has no room for
+    :param save_directory: The directory to save the images
+    :param interval_time: how much time between the start of each camera capture
+    :param start_time: time.monotonic() at the start of this loop
+    :param use_video_port: True to capture from the video port, needed while the video recorder is recording
+    :return: the name of the picture that was generated (for recording purposes)
+    """
+    now = datetime.today()
+    picture_number = 'image_' + str(now.strftime('%M%S') + '.jpg')
+    stream = io.BytesIO()
+    input_camera.capture(stream, format='jpeg', use_video_port=use_video_port)
+    if not staged_writer.put(save_directory, picture_number, stream.getvalue(), now):
+        frame_spool.add(now.strftime('%Y%m%d%H'), picture_number, stream.getvalue())
+    time.sleep(max(0, interval_time - (time.monotonic() - start_time)))
+    return picture_number
+
+
 def video_capture(input_camera, save_directory, record_time):
     """
     Method used to do video captures instead of picture captures
 
     NOTE: When experimenting with this method, there were jumps and spikes of missed recording times, may have been due
             to how it was set up, but primarily using the camera capture method, so may also be random instability.
+            See video_recorder.py for recording without gaps.
 
     :param input_camera: PiCamera object that's been initialized for the pi camera
     :param save_directory: The directory to save the images
@@ -86,6 +159,35 @@ def set_camera_mode(input_camera, camera_state: str):
     return input_camera
 
 
+def shutdown(recorder, staged_writer, frame_spool, containers):
+    """
+    Finishes any video clip, writes out the pictures still queued in the staged writer (any that fail go in the spool)
+    and closes the hour's container, so its index is written
+
+    :param recorder: CircularRecorder, or None if not recording video
+    :param staged_writer: StagedWriter, or None if not using staged writes
+    :param frame_spool: FrameSpool for pictures the writer could not write
+    :param containers: HourlyContainers, or None if not using container files
+    """
+    if recorder is not None:
+        try:
+            recorder.stop()
+        except Exception as e:
+            crab_library.print_log("VIDEO-ERROR: Issue while stopping the video recorder", 0)
+            print(e)
+    if staged_writer is not None:
+        staged_writer.wait_until_empty()
+        for directory, name, data, taken in staged_writer.take_failed():
+            frame_spool.add(taken.strftime('%Y%m%d%H'), name, data)
+    if containers is not None:
+        try:
+            containers.close()
+        except Exception as e:
+            crab_library.print_log("CONTAINER-ERROR: Issue while closing the hour's container", 0)
+            print(e)
+    crab_library.print_log("Camera capture stopped", 1)
+
+
 # Initialize PiCamera and bring it online
 camera = PiCamera()
 camera.resolution = (1280, 720)
@@ -93,6 +195,28 @@ check_counter_toggle = True
 check_counter = 10
 state = 0
 
+# Holds on to pictures while the USB drive is unavailable
+frame_spool = FrameSpool()
+
+# The hour's container file, if saving the pictures in containers instead of a file each
+containers = HourlyContainers() if crab_library.CAMERA_CONTAINER_FILES else None
+
+# Writes the pictures to the USB drive in the background
+staged_writer = StagedWriter(containers=containers) if crab_library.CAMERA_STAGED_WRITES else None
+
+# Records video into memory all the time, saving clips when triggered. The pictures are then taken from the video port,
+# as the still port would stop the recording for each picture.
+recorder = None
+if crab_library.CAMERA_VIDEO_RECORDER:
+    try:
+        recorder = CircularRecorder(camera)
+        recorder.start()
+    except Exception as e:
+        crab_library.print_log("VIDEO-ERROR: Issue starting the video recorder, only taking pictures", 0)
+        print(e)
+        recorder = None
+use_video_port = recorder is not None
+
 # Basic print statement and debug messages.
 crab_library.print_log(f"Log Severity meter set to: {crab_library.DEBUG_LOG_TOGGLE_THRESHOLD}", 0)
 crab_library.print_log("Initialized PiCamera Variables!", 1)
@@ -100,36 +224,94 @@ crab_library.print_log(f"USB_DIRECTORY: {crab_library.USB_DIRECTORY}", 1)
 crab_library.print_log(f"PICTURE_PARENT_LOCATION: {crab_library.CAMERA_PARENT_LOCATION}", 1)
 crab_library.print_log(f"WAIT_INTERVAL_SECONDS_PICTURE: {crab_library.CAMERA_WAIT_INTERVAL_SECONDS}", 1)
 crab_library.print_log(f"CAPTURE_HOURS_TO_CLEAR: {crab_library.CAMERA_HOURS_TO_CLEAR}", 1)
+crab_library.print_log(f"CAMERA_STAGED_WRITES: {crab_library.CAMERA_STAGED_WRITES}", 1)
+crab_library.print_log(f"CAMERA_CONTAINER_FILES: {crab_library.CAMERA_CONTAINER_FILES}", 1)
+crab_library.print_log(f"CAMERA_VIDEO_RECORDER: {recorder is not None}", 1)
 crab_library.print_log("----------------------------", 1)
 
-# Perform the first initialization
-picture_directory = crab_library.initialize(True, crab_library.CAMERA_TYPE_FLAG)
+# Perform the first initialization, if the USB drive is not ready yet the main loop keeps retrying
+picture_directory = None
+try:
+    picture_directory = crab_library.initialize(True, crab_library.CAMERA_TYPE_FLAG)
+except Exception as e:
+    crab_library.print_log("INITIALIZE-ERROR: Issue while attempting the first initialize of the picture directories", 0)
+    print(e)
+
+# Stop the same way on "kill" (SIGTERM) as on Ctrl+C, so the pictures still in memory are written out first
+signal.signal(signal.SIGTERM, lambda signal_number, frame: sys.exit(0))
 
 # Main loop for the camera capture methods
-while True:
-    # Every 10 iterations, check the file structure is still good and check the amount of space left. Only check every
-    # 10 iterations to save computation time.
-    check_counter = check_counter + 1
-    if check_counter > 10:
-        check_counter = 0
+try:
+    while True:
+        loop_start_time = time.monotonic()
+
+        # Pictures the staged writer could not write (USB drive removed), go in the spool
+        if staged_writer is not None:
+            for directory, name, data, taken in staged_writer.take_failed():
+                frame_spool.add(taken.strftime('%Y%m%d%H'), name, data)
+
+        # Every 10 iterations, check the file structure is still good and check the amount of space left. Only check
+        # every 10 iterations to save computation time.
+        check_counter = check_counter + 1
+        if check_counter > 10:
+            check_counter = 0
+            try:
+                picture_directory = crab_library.initialize(True, crab_library.CAMERA_TYPE_FLAG)
+                check_counter_toggle = False
+                if staged_writer is not None:
+                    crab_library.print_log(f"Staged writer metrics: {staged_writer.metrics()}", 2)
+            except Exception as e:
+                crab_library.print_log(
+                    "INITIALIZE-ERROR: Issue while attempting to initialize the picture directories", 0)
+                print(e)
+
+                # Keep capturing, the pictures are held in the spool until the drive is back
+                picture_directory = None
+
+        # Move a few spooled pictures back onto the drive each loop until caught up
+        if picture_directory is not None and len(frame_spool):
+            try:
+                frame_spool.flush(containers=containers)
+            except Exception as e:
+                crab_library.print_log("SPOOL-ERROR: Issue flushing spooled pictures to the capture folders", 0)
+                print(e)
+                picture_directory = None
+
+        # Start, extend or finish a video clip, depending on what triggered since the last loop. Triggers while the USB
+        # drive is unavailable are dropped, rather than saving a clip of a later moment once it is back
+        if recorder is not None:
+            try:
+                if picture_directory is not None:
+                    recorder.poll(picture_directory)
+                else:
+                    recorder.drop_triggers()
+            except Exception as e:
+                crab_library.print_log("VIDEO-ERROR: Issue while saving a video clip", 0)
+                print(e)
+
+        # Picture capture
         try:
-            picture_directory = crab_library.initialize(True, crab_library.CAMERA_TYPE_FLAG)
-            check_counter_toggle = False
+            if picture_directory is None:
+                picture_number = spool_picture_capture(camera, frame_spool, crab_library.CAMERA_WAIT_INTERVAL_SECONDS,
+                                                       use_video_port)
+                crab_library.print_log(f"Picture Capture spooled: {picture_number}", 2)
+            elif staged_writer is not None:
+                picture_number = staged_picture_capture(camera, staged_writer, frame_spool, picture_directory,
+                                                        crab_library.CAMERA_WAIT_INTERVAL_SECONDS, loop_start_time,
+                                                        use_video_port)
+                crab_library.print_log(f"Picture Capture staged: {picture_number}", 2)
+            else:
+                picture_number = picture_capture(camera, picture_directory, crab_library.CAMERA_WAIT_INTERVAL_SECONDS,
+                                                 use_video_port, containers)
+                crab_library.print_log(f"Picture Capture executed: {picture_number}", 2)
         except Exception as e:
-            crab_library.print_log("INITIALIZE-ERROR: Issue while attempting to initialize the picture directories", 0)
-            print(e)
+            crab_library.print_log("CAPTURE-ERROR: Issue while attempting to capture picture", 0)
 
-            # Wait the required interval, then continue, need these in here as the main wait is in the picture capture dir
+            # Wait the required interval, then continue, need these in here as the main wait is in the picture capture
+            # dir
             time.sleep(crab_library.CAMERA_WAIT_INTERVAL_SECONDS)
-            continue
-
-    # Picture capture
-    try:
-        picture_number = picture_capture(camera, picture_directory, crab_library.CAMERA_WAIT_INTERVAL_SECONDS)
-        crab_library.print_log(f"Picture Capture executed: {picture_number}", 2)
-    except Exception as e:
-        crab_library.print_log("CAPTURE-ERROR: Issue while attempting to capture picture", 0)
-
-        # Wait the required interval, then continue, need these in here as the main wait is in the picture capture dir
-        time.sleep(crab_library.CAMERA_WAIT_INTERVAL_SECONDS)
-        print(e)
+            print(e)
+except KeyboardInterrupt:
+    pass
+finally:
+    shutdown(recorder, staged_writer, frame_spool, containers)
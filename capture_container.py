@@ -0,0 +1,413 @@
+"""
+Joel Yuhas
+Raspberry-Pi/Hermit Crab project
+
+-------------------------------------------------------------------------------------
+capture_container.py
+-------------------------------------------------------------------------------------
+
+Per-hour container files for the pictures, used instead of hour folders when CAMERA_CONTAINER_FILES is True. An hour of
+pictures is about 1800 small files, and on the FAT formatted USB drive listing, cleaning up (check_space) and deleting
+folders gets slower the more files there are. With containers, each hour is a single "YYYYMMDDHH.crab" file in
+CAMERA_PARENT_LOCATION, and deleting an hour is one unlink.
+
+File layout:
+    - Frames, one after another, each:  FRAME_HEADER (magic, data length, crc32 of the data, timestamp, name length),
+                                        the picture name, the jpeg data
+    - Index, once the hour is closed:   JSON list of [name, data offset, data length, timestamp, crc32] for every
+                                        frame, followed by TRAILER (index offset, index length, magic)
+
+Frames are only ever added onto the end. When a container is opened for writing again (the program restarted, or
+pictures from the spool for an earlier hour), the index is cut off and written again when it is closed.
+
+If the program stops without closing the container (power loss, killed), there is no index. It is rebuilt by reading
+the frame headers from the start, stopping at the first frame that is cut off or doesn't start with the magic. The crc
+of each frame is checked when it is read, so a damaged picture is skipped like a corrupted jpeg would be.
+
+open_hour() opens an hour folder or a container the same way, so images_to_video.py, capture_index.py, etc. can read
+either without caring which it is, and without extracting anything.
+
+Existing hour folders can be packed into containers with "python3 capture_container.py <hour folder> ...".
+
+"""
+import argparse
+import json
+import os
+import struct
+import threading
+import zlib
+import crab_library
+
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+
+
+CONTAINER_SUFFIX = ".crab"
+FRAME_MAGIC = b"CRBF"
+INDEX_MAGIC = b"CRBX"
+
+# magic, data length, crc32 of the data, timestamp (seconds since the epoch), name length
+FRAME_HEADER = struct.Struct("<4sIIdH")
+# index offset, index length, magic
+TRAILER = struct.Struct("<QI4s")
+
+# How close a picture's modified time has to be to the next hour for it to be taken as from that hour, see FolderFrames
+FOLDER_MTIME_TOLERANCE_SECONDS = 120
+
+# Containers kept open at once by HourlyContainers, the current hour and the hour the spool is flushing
+MAX_OPEN_CONTAINERS = 2
+
+
+def container_path(hour_directory):
+    """
+    :param hour_directory: The hour folder path ("<captures>/YYYYMMDDHH"), which doesn't need to exist
+    :return: The container path for that hour
+    """
+    return hour_directory.parent / (hour_directory.name + CONTAINER_SUFFIX)
+
+
+def hour_name(path):
+    """
+    :param path: An hour folder or container
+    :return: The hour, "YYYYMMDDHH"
+    """
+    return path.name[:10]
+
+
+def hour_sources(captures_directory):
+    """
+    :param captures_directory: The captures directory
+    :return: Sorted list of the hour folders and containers in it, the container if an hour has both
+    """
+    sources = {}
+    for path in captures_directory.iterdir():
+        if path.name.endswith(CONTAINER_SUFFIX) and hour_name(path).isdigit():
+            sources[hour_name(path)] = path
+        elif path.is_dir() and path.name.isdigit():
+            sources.setdefault(path.name, path)
+    return [sources[hour] for hour in sorted(sources)]
+
+
+def picture_timestamp(hour, picture_name):
+    """
+    :param hour: The hour, "YYYYMMDDHH"
+    :param picture_name: The picture name, "image_MMSS.jpg"
+    :return: Seconds since the epoch the picture was taken
+    """
+    return datetime(int(hour[0:4]), int(hour[4:6]), int(hour[6:8]), int(hour[8:10]),
+                    int(picture_name[6:8]), int(picture_name[8:10])).timestamp()
+
+
+def _read_index(container_file, file_size):
+    # The index written on close, or None if there isn't one (or it doesn't look right)
+    if file_size < TRAILER.size:
+        return None
+    container_file.seek(file_size - TRAILER.size)
+    index_offset, index_length, magic = TRAILER.unpack(container_file.read(TRAILER.size))
+    if magic != INDEX_MAGIC or index_offset + index_length + TRAILER.size != file_size:
+        return None
+    container_file.seek(index_offset)
+    try:
+        return json.loads(container_file.read(index_length)), index_offset
+    except ValueError:
+        return None
+
+
+def scan(container_file, file_size, check_last=False):
+    """
+    Rebuilds the index by reading the frame headers from the start of the file
+
+    :param container_file: The container, opened in binary mode
+    :param file_size: Size of the container in bytes
+    :param check_last: True to also check the crc of the last frame, as that is the one a power loss would cut off
+    :return: The index, and the offset just after the last good frame
+    """
+    entries = []
+    offset = 0
+    while offset + FRAME_HEADER.size <= file_size:
+        container_file.seek(offset)
+        magic, length, crc, timestamp, name_length = FRAME_HEADER.unpack(container_file.read(FRAME_HEADER.size))
+        data_offset = offset + FRAME_HEADER.size + name_length
+        if magic != FRAME_MAGIC or data_offset + length > file_size:
+            break
+        try:
+            name = container_file.read(name_length).decode("utf-8")
+        except UnicodeDecodeError:
+            break
+        entries.append([name, data_offset, length, timestamp, crc])
+        offset = data_offset + length
+
+    if check_last and entries:
+        name, data_offset, length, timestamp, crc = entries[-1]
+        container_file.seek(data_offset)
+        if zlib.crc32(container_file.read(length)) != crc:
+            entries.pop()
+            offset = data_offset - FRAME_HEADER.size - len(name.encode("utf-8"))
+    return entries, offset
+
+
+def _load(container_file, check_last=False):
+    # The index, and where the frames end (where the next frame would go)
+    container_file.seek(0, os.SEEK_END)
+    file_size = container_file.tell()
+    index = _read_index(container_file, file_size)
+    if index is not None:
+        return index
+    return scan(container_file, file_size, check_last)
+
+
+class ContainerWriter:
+    """
+    Adds frames onto the end of one container
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "r+b" if path.exists() else "w+b")
+        self.entries, end = _load(self.file, check_last=True)
+        # Cut off the old index (or a frame cut off by a power loss), the frames continue from there
+        self.file.truncate(end)
+        self.file.seek(end)
+
+    def add(self, name, data, timestamp):
+        """
+        :param name: The picture name
+        :param data: The jpeg bytes
+        :param timestamp: Seconds since the epoch the picture was taken
+        """
+        name_bytes = name.encode("utf-8")
+        crc = zlib.crc32(data)
+        offset = self.file.tell()
+        self.file.write(FRAME_HEADER.pack(FRAME_MAGIC, len(data), crc, timestamp, len(name_bytes)) + name_bytes + data)
+        self.entries.append([name, offset + FRAME_HEADER.size + len(name_bytes), len(data), timestamp, crc])
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        """
+        Writes the index and closes the container
+        """
+        index_offset = self.file.tell()
+        index = json.dumps(self.entries).encode("utf-8")
+        self.file.write(index + TRAILER.pack(index_offset, len(index), INDEX_MAGIC))
+        self.file.close()
+
+
+class HourlyContainers:
+    """
+    Keeps the containers being added to open, up to MAX_OPEN_CONTAINERS of them, closing the one used longest ago when
+    another is needed. The spool flushing pictures for an earlier hour and the capture loop adding to the current hour
+    can then take turns without the containers being closed and opened again (writing and reading back the index) for
+    every picture. Safe to use from more than one thread (the capture loop, the spool and the staged writer).
+    """
+    def __init__(self):
+        # container path -> ContainerWriter, the one used last at the end
+        self.writers = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, hour_directory, picture_name, data, taken):
+        """
+        :param hour_directory: The hour folder path the picture would have been saved in
+        :param picture_name: The picture name, "image_MMSS.jpg"
+        :param data: The jpeg bytes
+        :param taken: datetime the picture was taken. The picture goes in the container for that hour, which is not
+                      always hour_directory's (the capture loop only moves on to the next hour folder every few loops)
+        """
+        path = container_path(hour_directory.parent / taken.strftime('%Y%m%d%H'))
+        with self.lock:
+            try:
+                writer = self.writers.get(path)
+                if writer is None:
+                    if len(self.writers) >= MAX_OPEN_CONTAINERS:
+                        _, oldest = self.writers.popitem(last=False)
+                        oldest.close()
+                    writer = self.writers[path] = ContainerWriter(path)
+                self.writers.move_to_end(path)
+                writer.add(picture_name, data, taken.timestamp())
+            except OSError:
+                # Most likely the USB drive was removed, start over with a fresh open once it is back
+                self._abandon()
+                raise
+
+    def flush(self):
+        with self.lock:
+            try:
+                for writer in self.writers.values():
+                    writer.flush()
+            except OSError:
+                self._abandon()
+                raise
+
+    def close(self):
+        with self.lock:
+            while self.writers:
+                _, writer = self.writers.popitem(last=False)
+                writer.close()
+
+    def _abandon(self):
+        # No index is written, it is rebuilt from the frames when next opened
+        for writer in self.writers.values():
+            try:
+                writer.file.close()
+            except OSError:
+                pass
+        self.writers.clear()
+
+
+class CaptureContainer:
+    """
+    Reads the pictures from a container, in the order they were taken
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        entries, _ = _load(self.file)
+        self.entries = sorted(entries, key=lambda entry: entry[3])
+        self.by_name = {entry[0]: entry for entry in self.entries}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        """
+        :return: generator of (picture name, jpeg bytes or None if damaged)
+        """
+        for entry in self.entries:
+            yield entry[0], self.read(entry[0])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def names(self):
+        return [entry[0] for entry in self.entries]
+
+    def taken(self, name):
+        """
+        :return: datetime the picture was taken, as saved in the index
+        """
+        return datetime.fromtimestamp(self.by_name[name][3])
+
+    def size(self, name):
+        return self.by_name[name][2]
+
+    def read(self, name):
+        """
+        :return: The picture's jpeg bytes, or None if the picture is damaged
+        """
+        _, data_offset, length, _, crc = self.by_name[name]
+        self.file.seek(data_offset)
+        data = self.file.read(length)
+        if zlib.crc32(data) != crc:
+            return None
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+class FolderFrames:
+    """
+    Reads the pictures from an hour folder, the same way as CaptureContainer.
+
+    The capture loop only moves on to the next hour folder every few loops, so the first few pictures of an hour can be
+    in the folder before. Those are told apart by their modified time, which is when they were written: a picture is
+    taken to be from the next hour if its modified time is within FOLDER_MTIME_TOLERANCE_SECONDS of that. If the
+    modified times were lost (i.e. copied to another computer), the folder's hour is used.
+    """
+    def __init__(self, path):
+        self.path = path
+        # Only the pictures (folders can also have a gaps.txt from the spool, and video clips)
+        self.times = {}
+        for picture_path in path.glob("image_*.jpg"):
+            timestamp = picture_timestamp(path.name, picture_path.name)
+            if abs(picture_path.stat().st_mtime - (timestamp + 3600)) <= FOLDER_MTIME_TOLERANCE_SECONDS:
+                timestamp = timestamp + 3600
+            self.times[picture_path.name] = timestamp
+        self.paths = sorted(path.glob("image_*.jpg"), key=lambda picture_path: self.times[picture_path.name])
+        self.by_name = {picture_path.name: picture_path for picture_path in self.paths}
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        for picture_path in self.paths:
+            yield picture_path.name, self.read(picture_path.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def names(self):
+        return [picture_path.name for picture_path in self.paths]
+
+    def taken(self, name):
+        """
+        :return: datetime the picture was taken
+        """
+        return datetime.fromtimestamp(self.times[name])
+
+    def size(self, name):
+        return self.by_name[name].stat().st_size
+
+    def read(self, name):
+        return self.by_name[name].read_bytes()
+
+    def close(self):
+        pass
+
+
+def open_hour(path):
+    """
+    :param path: An hour folder or container
+    :return: CaptureContainer or FolderFrames for it
+    """
+    if path.name.endswith(CONTAINER_SUFFIX):
+        return CaptureContainer(path)
+    return FolderFrames(path)
+
+
+def pack_folder(hour_directory, remove=False):
+    """
+    Packs the pictures in an hour folder into a container (added onto the container if there already is one)
+
+    :param hour_directory: The hour folder
+    :param remove: True to delete each picture once packed, and the folder if it is then empty
+    :return: The number of pictures packed
+    """
+    writer = ContainerWriter(container_path(hour_directory))
+    try:
+        with FolderFrames(hour_directory) as frames:
+            for name, data in frames:
+                writer.add(name, data, frames.taken(name).timestamp())
+    finally:
+        writer.close()
+
+    if remove:
+        for name in frames.names():
+            os.remove(hour_directory / name)
+        if not any(hour_directory.iterdir()):
+            hour_directory.rmdir()
+    return len(frames)
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("hour_folders", nargs="+", type=Path, help="Hour folders to pack into containers")
+    parser.add_argument("--remove", action="store_true", help="Delete the pictures from the folders once packed")
+    return parser.parse_args()
+
+
+def main(args):
+    for hour_directory in args.hour_folders:
+        packed = pack_folder(hour_directory, args.remove)
+        crab_library.print_log(f"CONTAINER: Packed {packed} pictures into {container_path(hour_directory)}", 1)
+
+
+if __name__ == "__main__":
+    main(arg_parser())
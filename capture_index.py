@@ -0,0 +1,236 @@
+"""
+Joel Yuhas
+Raspberry-Pi/Hermit Crab project
+
+-------------------------------------------------------------------------------------
+capture_index.py
+-------------------------------------------------------------------------------------
+
+Builds a small index of each hour folder of pictures, so an hour can be checked without copying the whole folder off
+the USB drive and running images_to_video.py on it.
+
+For each hour folder (or container file, see capture_container.py) in CAMERA_PARENT_LOCATION, the following is made in
+CAPTURE_INDEX_LOCATION/<hour>/:
+    - tiles/: a THUMBNAIL_SIZE thumbnail of the first picture of each minute, at most 60 for the hour. Only these are
+              saved, a thumbnail of every picture would be as many small files as the hour itself.
+    - contact_sheet.jpg: the tiles in a grid, one for each minute of the hour
+    - manifest.json: the frame count, total size in bytes, mean brightness and an activity score for the hour, the
+                     values for each picture, and which picture is the tile for each minute
+
+The activity score is the average difference between each picture and the one before it, so an hour with crabs moving
+around scores higher than an hour of an empty tank.
+
+The index is kept up to date incrementally. An hour is skipped if its folder's (or container's) modified time is the
+same as the last run, and only new pictures are processed otherwise. Index folders for hours that were deleted
+(check_space) are removed.
+
+Run once with "python3 capture_index.py", or keep running in the background with "--watch". The "--captures" and
+"--index" options can be used to index a copy of the captures directory on another computer.
+
+"""
+import argparse
+import json
+import os
+import shutil
+import crab_library
+
+from capture_container import hour_name, hour_sources, open_hour
+from pathlib import Path
+
+
+THUMBNAIL_SIZE = (160, 90)
+CONTACT_SHEET_COLUMNS = 10
+CAPTURE_INDEX_INTERVAL_SECONDS = 60
+
+# Size the thumbnails are shrunk down to before comparing them for the activity score, small enough that sensor noise
+# is mostly averaged out
+ACTIVITY_COMPARE_SIZE = (32, 18)
+
+
+def load_manifest(index_directory):
+    """
+    :param index_directory: The index folder for one hour
+    :return: The saved manifest, or None if there isn't one yet
+    """
+    try:
+        with open(index_directory / 'manifest.json') as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _activity_image(cv2, thumbnail):
+    gray = cv2.cvtColor(thumbnail, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, ACTIVITY_COMPARE_SIZE, interpolation=cv2.INTER_AREA)
+
+
+def make_contact_sheet(cv2, tile_paths, output_path):
+    """
+    Puts the tiles into a grid and saves it
+
+    :param cv2: the cv2 module (imported by the caller)
+    :param tile_paths: Sorted list of the tiles for the hour
+    :param output_path: Where to save the contact sheet
+    """
+    tiles = [cv2.imread(str(tile_path)) for tile_path in tile_paths]
+    tiles = [tile for tile in tiles if tile is not None]
+    if not tiles:
+        return
+
+    # Pad out the last row with blank tiles
+    while len(tiles) % CONTACT_SHEET_COLUMNS and len(tiles) > CONTACT_SHEET_COLUMNS:
+        tiles.append(tiles[0] * 0)
+    rows = [cv2.hconcat(tiles[i:i + CONTACT_SHEET_COLUMNS]) for i in range(0, len(tiles), CONTACT_SHEET_COLUMNS)]
+    cv2.imwrite(str(output_path), cv2.vconcat(rows), [cv2.IMWRITE_JPEG_QUALITY, 70])
+
+
+def make_thumbnail(cv2, numpy, data):
+    """
+    :param cv2: the cv2 module (imported by the caller)
+    :param numpy: the numpy module (imported by the caller)
+    :param data: The picture's jpeg bytes, or None if it is damaged
+    :return: The THUMBNAIL_SIZE thumbnail, or None if the picture could not be decoded
+    """
+    if data is None:
+        return None
+    # Reduced decoding lets the jpeg decoder skip most of the work, much faster than loading at full size
+    image = cv2.imdecode(numpy.frombuffer(data, numpy.uint8), cv2.IMREAD_REDUCED_COLOR_8)
+    if image is None:
+        return None
+    # rotate 180 (camera mounted upside down atm)
+    return cv2.rotate(cv2.resize(image, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA), cv2.ROTATE_180)
+
+
+def index_hour(cv2, numpy, hour_path, index_directory):
+    """
+    Brings the index for one hour up to date
+
+    :param cv2: the cv2 module (imported by the caller)
+    :param numpy: the numpy module (imported by the caller)
+    :param hour_path: The hour folder or container of pictures
+    :param index_directory: The index folder for that hour
+    :return: The manifest, or None if the hour was already up to date
+    """
+    folder_mtime = hour_path.stat().st_mtime
+    manifest = load_manifest(index_directory)
+    if manifest is not None and manifest["folder_mtime"] == folder_mtime:
+        return None
+    if manifest is None:
+        manifest = {"frames": {}, "tiles": {}}
+
+    tile_directory = index_directory / 'tiles'
+    tile_directory.mkdir(parents=True, exist_ok=True)
+    frames = manifest["frames"]
+    # minute of the hour -> the picture used as its tile
+    tiles = manifest["tiles"]
+    tiles_added = False
+
+    # Only the pictures that have not been seen before. The previous picture's thumbnail is kept from one picture to
+    # the next, it only has to be made again for the first new picture of a run
+    with open_hour(hour_path) as pictures:
+        names = pictures.names()
+        previous = None
+        for i, name in enumerate(names):
+            if name in frames:
+                continue
+            if previous is None and i > 0:
+                previous = make_thumbnail(cv2, numpy, pictures.read(names[i - 1]))
+
+            data = pictures.read(name)
+            thumbnail = make_thumbnail(cv2, numpy, data)
+            if thumbnail is None:
+                crab_library.print_log(f"INDEX-ERROR: Picture most likely corrupted {hour_path / name}", 0)
+                continue
+
+            compare = _activity_image(cv2, thumbnail)
+            difference = None
+            if previous is not None:
+                difference = float(cv2.mean(cv2.absdiff(compare, _activity_image(cv2, previous)))[0])
+
+            # The first picture of each minute is its tile. Pictures from the next hour that were filed with this one
+            # are left out
+            taken = pictures.taken(name)
+            if taken.strftime('%Y%m%d%H') == hour_name(hour_path) and str(taken.minute) not in tiles:
+                cv2.imwrite(str(tile_directory / name), thumbnail, [cv2.IMWRITE_JPEG_QUALITY, 70])
+                tiles[str(taken.minute)] = name
+                tiles_added = True
+
+            frames[name] = {
+                "bytes": len(data),
+                "brightness": float(cv2.mean(cv2.cvtColor(thumbnail, cv2.COLOR_BGR2GRAY))[0]),
+                "difference": difference,
+            }
+            previous = thumbnail
+
+    differences = [frame["difference"] for frame in frames.values() if frame["difference"] is not None]
+    manifest.update({
+        "folder_mtime": folder_mtime,
+        "frame_count": len(frames),
+        "byte_size": sum(frame["bytes"] for frame in frames.values()),
+        "mean_brightness": sum(frame["brightness"] for frame in frames.values()) / len(frames) if frames else 0,
+        "activity_score": sum(differences) / len(differences) if differences else 0,
+    })
+
+    if tiles_added:
+        make_contact_sheet(cv2, [tile_directory / tiles[minute] for minute in sorted(tiles, key=int)],
+                           index_directory / 'contact_sheet.jpg')
+
+    # Written to a temp file and renamed, so the manifest is never half written
+    temp_path = index_directory / 'manifest.json.tmp'
+    with open(temp_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(temp_path, index_directory / 'manifest.json')
+    return manifest
+
+
+def update_index(captures_directory=crab_library.CAMERA_PARENT_LOCATION,
+                 index_root=crab_library.CAPTURE_INDEX_LOCATION):
+    """
+    Brings the index for every hour up to date, and removes the index for any hours that were deleted
+
+    :param captures_directory: The captures directory
+    :param index_root: Where the index folders are kept
+    :return: The number of hours that were updated
+    """
+    # Only imported here, so the rest of the project can import this module without opencv
+    import cv2
+    import numpy
+
+    index_root.mkdir(parents=True, exist_ok=True)
+    hours = hour_sources(captures_directory)
+    updated = 0
+    for hour_path in hours:
+        try:
+            if index_hour(cv2, numpy, hour_path, index_root / hour_name(hour_path)) is not None:
+                crab_library.print_log(f"INDEX: Updated {hour_name(hour_path)}", 2)
+                updated = updated + 1
+        except Exception as e:
+            crab_library.print_log(f"INDEX-ERROR: Issue indexing {hour_name(hour_path)}: {e}", 0)
+
+    hour_names = {hour_name(hour_path) for hour_path in hours}
+    for index_directory in index_root.iterdir():
+        if index_directory.is_dir() and index_directory.name not in hour_names:
+            crab_library.print_log(f"INDEX: Removing index for deleted hour {index_directory.name}", 2)
+            shutil.rmtree(index_directory, ignore_errors=True)
+
+    return updated
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--watch", action="store_true",
+                        help=f"Keep running, updating the index every {CAPTURE_INDEX_INTERVAL_SECONDS} seconds")
+    parser.add_argument("--captures", type=Path, default=crab_library.CAMERA_PARENT_LOCATION,
+                        help="The captures directory to index")
+    parser.add_argument("--index", type=Path, default=crab_library.CAPTURE_INDEX_LOCATION,
+                        help="Where to keep the index")
+    return parser.parse_args()
+
+
+def main(args):
+    crab_library.run_watch(lambda: update_index(args.captures, args.index), CAPTURE_INDEX_INTERVAL_SECONDS, args.watch,
+                           "INDEX-ERROR: Issue while updating the capture index")
+
+
+if __name__ == "__main__":
+    main(arg_parser())
@@ -8,6 +8,7 @@ Contains all constants and cross used definitions for running and managing the p
 """
 import os
 import subprocess
+import time
 
 from datetime import datetime
 from pathlib import Path
@@ -61,6 +62,88 @@ IDEAL_HUMID_UPPER_LIMIT = 85
 IDEAL_HUMID_LOWER_LIMIT = 75
 
 
+"""
+Values for the sensor health states (see Sensor.py)
+
+SENSOR_DEGRADED_ERROR_LIMIT: Errors in a row that are retried every loop, before the sensor is put into backoff
+SENSOR_OFFLINE_ERROR_LIMIT: Errors in a row before the sensor is considered offline
+SENSOR_BACKOFF_INITIAL_SECONDS/SENSOR_BACKOFF_MAX_SECONDS: Time to wait before trying a failing sensor again, doubled
+                                                          after every failed try up to the max. Offline sensors are
+                                                          tried every SENSOR_BACKOFF_MAX_SECONDS
+SENSOR_RECOVERY_SUCCESS_COUNT: Good readings in a row before a recovering sensor is considered healthy again
+"""
+SENSOR_DEGRADED_ERROR_LIMIT = 3
+SENSOR_OFFLINE_ERROR_LIMIT = 50
+SENSOR_BACKOFF_INITIAL_SECONDS = 4
+SENSOR_BACKOFF_MAX_SECONDS = 300
+SENSOR_RECOVERY_SUCCESS_COUNT = 3
+
+"""
+Values for the anomaly detector (see anomaly_detector.py), which watches for the two sensors drifting apart, getting
+stuck, or jumping
+
+ANOMALY_WARMUP_SAMPLES: Readings needed before drift is checked, so the running stats have settled
+ANOMALY_DRIFT_SIGMAS: How many standard deviations the recent sensor difference can be from the long running average
+ANOMALY_MAX_TEMP_DIFFERENCE_F/ANOMALY_MAX_HUMID_DIFFERENCE: Largest difference between the sensors that is still ok
+ANOMALY_MAX_TEMP_RATE_F/ANOMALY_MAX_HUMID_RATE: Fastest change per second that is still believable
+ANOMALY_STUCK_SAMPLES: Readings in a row with the exact same temperature and humidity before a sensor is called stuck
+ANOMALY_ALERT_COOLDOWN_SECONDS: Time before the same alert is raised again
+"""
+ANOMALY_WARMUP_SAMPLES = 300
+ANOMALY_DRIFT_SIGMAS = 4
+ANOMALY_MAX_TEMP_DIFFERENCE_F = 2.0
+ANOMALY_MAX_HUMID_DIFFERENCE = 5.0
+ANOMALY_MAX_TEMP_RATE_F = 0.5
+ANOMALY_MAX_HUMID_RATE = 2.0
+ANOMALY_STUCK_SAMPLES = 900
+ANOMALY_ALERT_COOLDOWN_SECONDS = 600
+
+"""
+Values for staged camera writes (see staged_writer.py). Pictures are captured into memory and written to the USB drive
+in batches by a separate thread, so a slow write never delays the next picture.
+
+CAMERA_STAGED_WRITES: True to use staged writes, False to capture straight to the USB drive like before
+CAMERA_STAGED_QUEUE_FRAMES: Most pictures waiting in memory to be written
+CAMERA_STAGED_BATCH_FRAMES/CAMERA_STAGED_BATCH_SECONDS: Pictures are written once this many are waiting, or once the
+                                                       oldest has waited this long
+CAMERA_STAGED_PUT_TIMEOUT_SECONDS: How long the capture waits for room in a full queue, before the picture is put in the
+                                   spool instead
+"""
+CAMERA_STAGED_WRITES = True
+CAMERA_STAGED_QUEUE_FRAMES = 30
+CAMERA_STAGED_BATCH_FRAMES = 10
+CAMERA_STAGED_BATCH_SECONDS = 20
+CAMERA_STAGED_PUT_TIMEOUT_SECONDS = 0.5
+
+"""
+True to save each hour of pictures in a single "YYYYMMDDHH.crab" container file instead of an hour folder with a file
+per picture (see capture_container.py)
+"""
+CAMERA_CONTAINER_FILES = False
+
+"""
+Values for the video recorder (see video_recorder.py), which keeps the last few seconds of video in memory and only
+saves a clip when something happens (motion, a climate event from the temp/humid program, or a manual trigger)
+
+CAMERA_VIDEO_RECORDER: True to run the recorder alongside the picture captures. Off by default, as the pictures then
+                       have to come from the video port, which are lower quality than the still port's
+VIDEO_PRE_TRIGGER_SECONDS/VIDEO_POST_TRIGGER_SECONDS: Video saved from before and after the trigger, any trigger during
+                                                     the clip extends it, up to VIDEO_MAX_CLIP_SECONDS
+VIDEO_SPLITTER_PORT: Camera port used for the recording, port 0 is left for the picture captures
+VIDEO_MOTION_MAGNITUDE/VIDEO_MOTION_BLOCKS: Motion is triggered when more than VIDEO_MOTION_BLOCKS of the 16x16 blocks
+                                            in a frame moved more than VIDEO_MOTION_MAGNITUDE
+VIDEO_TRIGGER_DIRECTORY: Any file put here triggers a clip, named after the reason (on tmpfs so it is quick and
+                         doesn't touch the SD card). "touch /dev/shm/hermitcrab-triggers/manual" triggers one by hand
+"""
+CAMERA_VIDEO_RECORDER = False
+VIDEO_PRE_TRIGGER_SECONDS = 10
+VIDEO_POST_TRIGGER_SECONDS = 20
+VIDEO_MAX_CLIP_SECONDS = 120
+VIDEO_SPLITTER_PORT = 1
+VIDEO_MOTION_MAGNITUDE = 60
+VIDEO_MOTION_BLOCKS = 10
+VIDEO_TRIGGER_DIRECTORY = Path("/dev/shm/hermitcrab-triggers")
+
 """
 Time of day thresholds for camera capture in HHMM
 """
@@ -96,6 +179,108 @@ Currently using:
 USB_DIRECTORY = Path("/media/pi/HERMITCRAB")
 TEMP_HUMID_PARENT_LOCATION = USB_DIRECTORY / 'temp-humid-logs'
 CAMERA_PARENT_LOCATION = USB_DIRECTORY / 'captures'
+CAPTURE_INDEX_LOCATION = USB_DIRECTORY / 'capture-index'
+DASHBOARD_LOCATION = USB_DIRECTORY / 'dashboard'
+
+"""
+Devices that need to be present before each program can be started by startup.py
+
+CAMERA_DEVICE_PATHS: Any one of these existing means the pi camera stack is up (vchiq for the legacy picamera stack,
+                     video0 for the newer v4l2 stack)
+GPIO_DEVICE_PATH: Exists once the GPIO driver is loaded and RPi.GPIO can be set up
+"""
+CAMERA_DEVICE_PATHS = [Path("/dev/vchiq"), Path("/dev/video0")]
+GPIO_DEVICE_PATH = Path("/dev/gpiomem")
+
+"""
+Values used by startup.py when waiting for the devices above to come online
+
+STARTUP_POLL_INITIAL_SECONDS: First wait between checks, doubled after every failed check
+STARTUP_POLL_MAX_SECONDS: The most time to wait between two checks
+STARTUP_TIMEOUT_SECONDS: Give up waiting after this long and start the program anyway, the programs retry initialize()
+                         on their own
+"""
+STARTUP_POLL_INITIAL_SECONDS = 0.1
+STARTUP_POLL_MAX_SECONDS = 2
+STARTUP_TIMEOUT_SECONDS = 120
+
+"""
+Values for the spool (see spool.py), which holds on to readings and pictures while the USB drive is unavailable.
+
+SPOOL_DIRECTORY: Kept on tmpfs (RAM), so that it survives the programs crashing, but not wear out the SD card
+SPOOL_MAX_SAMPLES: Most temp/humid readings to hold, at 2 seconds each 20000 is a little over 11 hours
+SPOOL_MAX_FRAMES: Most pictures to hold, each picture is around 300KB at 1280x720
+SPOOL_FLUSH_SAMPLES_PER_TICK/SPOOL_FLUSH_FRAMES_PER_TICK: How much is moved to the USB drive each loop once it's back,
+                                                        kept small so catching up never holds up the next capture
+"""
+SPOOL_DIRECTORY = Path("/dev/shm/hermitcrab-spool")
+SPOOL_MAX_SAMPLES = 20000
+SPOOL_MAX_FRAMES = 150
+SPOOL_FLUSH_SAMPLES_PER_TICK = 500
+SPOOL_FLUSH_FRAMES_PER_TICK = 5
+
+"""
+Values for the log shipper (see log_shipper.py), which copies new log data off the pi.
+
+SHIPPER_DESTINATION: Where the bundles are delivered, any mounted directory (network share, second drive, etc.)
+SHIPPER_STATE_DIRECTORY: Where the shipper keeps how far into each file it has shipped, on the SD card so it is not
+                         lost when the USB drive is swapped
+SHIPPER_MAX_BUNDLE_BYTES: Most (uncompressed) bytes put into a single bundle
+SHIPPER_MAX_BYTES_PER_SECOND: Most bytes read per second, so the shipper never competes with the capture programs
+SHIPPER_INTERVAL_SECONDS: Time between each check for new data when running with --watch
+"""
+SHIPPER_DESTINATION = Path("/mnt/hermitcrab-share")
+SHIPPER_STATE_DIRECTORY = Path("/home/pi/.hermitcrab-shipper")
+SHIPPER_MAX_BUNDLE_BYTES = 5 * 1024 * 1024
+SHIPPER_MAX_BYTES_PER_SECOND = 256 * 1024
+SHIPPER_INTERVAL_SECONDS = 300
+
+
+def usb_ready():
+    """
+    Checks whether the USB drive is mounted and writable. Only checking is_dir() is not enough, as the mount point
+    directory can exist on the SD card before the drive itself is mounted on top of it.
+
+    :return: True if the USB_DIRECTORY is mounted and writable
+    """
+    return os.path.ismount(USB_DIRECTORY) and os.access(USB_DIRECTORY, os.W_OK)
+
+
+def request_video_trigger(reason):
+    """
+    Asks the video recorder in camera_capture.py to save a clip (see video_recorder.py). Done with a file in
+    VIDEO_TRIGGER_DIRECTORY, so it works from any of the programs.
+
+    :param reason: Short reason for the clip, i.e. "fan-on", used in the clip's file name
+    """
+    # Nothing would ever pick the file up
+    if not CAMERA_VIDEO_RECORDER:
+        return
+    VIDEO_TRIGGER_DIRECTORY.mkdir(parents=True, exist_ok=True)
+    (VIDEO_TRIGGER_DIRECTORY / f"{reason}-{datetime.today().strftime('%H%M%S')}").touch()
+
+
+def run_watch(function, interval_seconds, watch, error_message):
+    """
+    Runs function once, or keeps running it every interval_seconds if watch. Used by the programs that only read what
+    the capture programs saved (capture_index.py, dashboard.py, log_shipper.py). They run at a lower priority so they
+    never compete with the capture programs, and an error is logged and tried again next time rather than stopping.
+
+    :param function: Called with no arguments
+    :param interval_seconds: Time between each run
+    :param watch: True to keep running, False to run once
+    :param error_message: Logged along with the exception if function raises
+    """
+    os.nice(10)
+    while True:
+        try:
+            function()
+        except Exception as e:
+            print_log(f"{error_message}: {e}", 0)
+
+        if not watch:
+            break
+        time.sleep(interval_seconds)
 
 
 def print_log(message, value):
@@ -132,9 +317,9 @@ def initialize(check_counter_toggle, type):
                 - picture_directory if picture capture
                 - False if issue
     """
-    # Ensure USB directory exists
-    if not USB_DIRECTORY.is_dir():
-        print_log(f"USB-ERROR: provided USB directory does not exists: {USB_DIRECTORY}", 0)
+    # Ensure the USB drive is mounted and writable, not just that the mount point exists
+    if not usb_ready():
+        print_log(f"USB-ERROR: provided USB directory is not mounted or not writable: {USB_DIRECTORY}", 0)
         raise AssertionError
 
     # Temp and Humidity initialization
@@ -152,9 +337,13 @@ def initialize(check_counter_toggle, type):
         return log_file
 
     elif type == CAMERA_TYPE_FLAG:
-        # Ensure the sub-directory with a folder as the date exists
+        # Ensure the sub-directory with a folder as the date exists. With container files the pictures go in
+        # "<picture_directory>.crab" instead, so the folder is not needed
         picture_directory = CAMERA_PARENT_LOCATION / str(datetime.today().strftime('%Y%m%d%H'))
-        picture_directory.mkdir(exist_ok=True)
+        if CAMERA_CONTAINER_FILES:
+            CAMERA_PARENT_LOCATION.mkdir(exist_ok=True)
+        else:
+            picture_directory.mkdir(exist_ok=True)
         print_log("Picture Directory initialization success", 2)
         return picture_directory
     else:
@@ -172,10 +361,10 @@ def check_space(type):
     .txt files depending on the file type
 
     NOTE:
-    - For PICTURES: Deletes FOLDERS, each folder with an hour worth of data. Oldest folders deleted. Value based on
-                    CAPTURE_HOURS_TO_CLEAR
-    - For TEMP/HUMID: Deletes TEXT FILES. Each text file holds a days worth of temp/humidity data. Value based on
-                    LOG_DAYS_TO_CLEA
+    - For PICTURES: Deletes FOLDERS and container files (see capture_container.py), each with an hour worth of data.
+                    Oldest hours deleted. Value based on CAPTURE_HOURS_TO_CLEAR
+    - For TEMP/HUMID: Deletes TEXT FILES. Each text file holds a days worth of temp/humidity data, compressed or not
+                    (see log_store.py). Value based on LOG_DAYS_TO_CLEAR
 
     :param type: Determines what data to delete, either temp/humid or pictures
     """
@@ -186,32 +375,41 @@ def check_space(type):
     if space_available < SPACE_THRESHOLD_KB:
         # Clean the camera files
         if type == CAMERA_TYPE_FLAG:
-            folder_list = []
-            for folder in CAMERA_PARENT_LOCATION.iterdir():
-                folder_list.append(int(str(folder)[-10:]))
+            # Each hour can be a folder, a container file, a gaps file from the spool, or a mix of them, so group them
+            # by the hour at the front
+            hour_paths = {}
+            for path in CAMERA_PARENT_LOCATION.iterdir():
+                if path.name[:10].isdigit():
+                    hour_paths.setdefault(path.name[:10], []).append(path)
 
             # Remove 2 hours of info to clear up files
             try:
                 for i in range(CAMERA_HOURS_TO_CLEAR):
-                    oldest_folder = min(folder_list)
-                    print_log(f"CLEANING: Removing the following: {oldest_folder}", 1)
-                    os.system(f"rm -rf {CAMERA_PARENT_LOCATION / (str(oldest_folder))}")
+                    oldest_hour = min(hour_paths)
+                    print_log(f"CLEANING: Removing the following: {oldest_hour}", 1)
+                    for path in hour_paths.pop(oldest_hour):
+                        if path.is_dir():
+                            os.system(f"rm -rf {path}")
+                        else:
+                            os.remove(path)
 
             except Exception:
                 print_log("DELETION-ERROR: Issue while attempting to free up space ", 0)
 
         # Clean the temp and humidity files
         elif type == TEMP_HUMID_TYPE_FLAG:
-            file_list = []
+            # Each day can have several files (.txt, .txt.gz, .txt.gz.idx), so group them by the day at the front
+            day_files = {}
             for file in TEMP_HUMID_PARENT_LOCATION.iterdir():
-                file_list.append(int(str(file)[-10:-4]))
+                day_files.setdefault(file.name[:8], []).append(file)
 
             # Remove 1 day of info to clear up files
             try:
                 for i in range(TEMP_HUMID_LOG_DAYS_TO_CLEAR):
-                    oldest_file = min(file_list)
-                    print_log(f"CLEANING: Removing the following: {oldest_file}", 1)
-                    os.system(f"rm -rf {TEMP_HUMID_PARENT_LOCATION / (str(oldest_file) + '.txt')}")
+                    oldest_day = min(day_files)
+                    print_log(f"CLEANING: Removing the following: {oldest_day}", 1)
+                    for file in day_files.pop(oldest_day):
+                        os.remove(file)
 
             except Exception:
                 print_log("DELETION-ERROR: Issue while attempting to free up space ", 0)
\ No newline at end of file
@@ -0,0 +1,610 @@
+"""
+Joel Yuhas
+Raspberry-Pi/Hermit Crab project
+
+-------------------------------------------------------------------------------------
+dashboard.py
+-------------------------------------------------------------------------------------
+
+Makes a single static HTML page (DASHBOARD_LOCATION/index.html) showing how the tank has been doing, so the raw logs
+don't have to be read by hand. Everything is inside the one file (charts are inline SVG, the picture is embedded), so
+it can be copied off the USB drive and opened anywhere.
+
+The page has:
+    - Temperature and humidity over time (min, mean and max), with the IDEAL_* ranges shaded
+    - Fan duty cycle (percent of readings with the fan on) for each day, week or month
+    - Sensor error rate for each sensor, each day, week or month. Counts readings logged as "err" (the sensor failed,
+      or was waiting out a backoff, see Sensor.py) or not believable
+    - Free space on the USB drive over time
+    - The latest tile from the capture index (see capture_index.py)
+    - A table of the most recent days
+
+Each day's log is boiled down to a small summary (DASHBOARD_BUCKET_MINUTES buckets of min/mean/max) that is saved in
+DASHBOARD_LOCATION/days/YYYYMMDD.json, along with the names, sizes and modified times of that day's log files. A day is
+only read again if those changed, so normally only today is read. Summaries of days that were deleted by check_space
+are kept, so the history goes back further than the logs on the drive.
+
+The charts are made from the summaries, and merged down to at most DASHBOARD_CHART_POINTS points (the line charts) or
+DASHBOARD_BAR_GROUPS bars (days are grouped into weeks, then months), so the page stays small no matter how many months
+of history there are.
+
+Free space isn't in the logs, so each run adds a sample to DASHBOARD_LOCATION/disk-usage.json.
+
+Run once with "python3 dashboard.py", or keep running in the background with "--watch". The "--logs", "--index" and
+"--output" options can be used on a copy of the USB drive on another computer.
+
+"""
+import argparse
+import base64
+import html
+import json
+import math
+import os
+import shutil
+import crab_library
+import log_store
+
+from datetime import datetime, timedelta
+from pathlib import Path
+
+
+DASHBOARD_INTERVAL_SECONDS = 600
+DASHBOARD_BUCKET_MINUTES = 15
+DASHBOARD_CHART_POINTS = 400
+DASHBOARD_BAR_GROUPS = 60
+DASHBOARD_TABLE_DAYS = 14
+
+# At most one disk usage sample per DASHBOARD_DISK_SAMPLE_MINUTES, and only the last DASHBOARD_DISK_SAMPLES are kept
+# (a year of hourly samples)
+DASHBOARD_DISK_SAMPLE_MINUTES = 60
+DASHBOARD_DISK_SAMPLES = 24 * 365
+
+# Readings outside of these are glitches (the sensors have read 800F before) and are counted as errors
+PLAUSIBLE_TEMP_RANGE_F = (0, 150)
+PLAUSIBLE_HUMID_RANGE = (0, 100)
+
+# Bumped when the summary format changes, so the saved summaries are all made again
+SUMMARY_VERSION = 1
+
+CHART_WIDTH = 900
+CHART_HEIGHT = 180
+CHART_MARGIN = 40
+
+
+"""
+Day summaries
+"""
+
+
+def day_signature(day, log_directory):
+    """
+    :return: The names, sizes and modified times of the day's log files, if this is the same as the saved summary the
+             day has not changed
+    """
+    signature = []
+    for path in log_store.day_log_paths(day, log_directory):
+        stat = path.stat()
+        signature.append([path.name, stat.st_size, stat.st_mtime])
+    return signature
+
+
+def _plausible(humidity, temperature):
+    return (humidity is not None and temperature is not None
+            and PLAUSIBLE_HUMID_RANGE[0] <= humidity <= PLAUSIBLE_HUMID_RANGE[1]
+            and PLAUSIBLE_TEMP_RANGE_F[0] <= temperature <= PLAUSIBLE_TEMP_RANGE_F[1])
+
+
+def summarize_day(day, log_directory):
+    """
+    Reads one day of logs down to its summary
+
+    :param day: The day in "YYYYMMDD" format
+    :param log_directory: The directory with the daily logs
+    :return: The summary. Each bucket is [minute of the day, readings, temp min, temp mean, temp max, humid min,
+             humid mean, humid max], only buckets with readings are included
+    """
+    readings = 0
+    dropped = 0
+    errors = [0, 0]
+    fan_on = 0
+    fan_known = 0
+    in_ideal = 0
+    # minute of the day -> [count, temp min, temp sum, temp max, humid min, humid sum, humid max]
+    buckets = {}
+
+    for record in log_store.iter_day_records(day, log_directory):
+        if record.gap is not None:
+            dropped = dropped + record.gap
+            continue
+        readings = readings + 1
+
+        # Average of the sensors that have a believable reading, the same as temp_humid_capture.py
+        temperatures = []
+        humidities = []
+        for i, (humidity, temperature) in enumerate(((record.humidity_1, record.temperature_1),
+                                                     (record.humidity_2, record.temperature_2))):
+            if _plausible(humidity, temperature):
+                temperatures.append(temperature)
+                humidities.append(humidity)
+            else:
+                errors[i] = errors[i] + 1
+
+        if record.fan_status is not None:
+            fan_known = fan_known + 1
+            if record.fan_status == "on":
+                fan_on = fan_on + 1
+
+        if not temperatures:
+            continue
+        temperature = sum(temperatures) / len(temperatures)
+        humidity = sum(humidities) / len(humidities)
+        if (crab_library.IDEAL_TEMP_LOWER_LIMIT <= temperature <= crab_library.IDEAL_TEMP_UPPER_LIMIT and
+                crab_library.IDEAL_HUMID_LOWER_LIMIT <= humidity <= crab_library.IDEAL_HUMID_UPPER_LIMIT):
+            in_ideal = in_ideal + 1
+
+        minute = record.timestamp.hour * 60 + record.timestamp.minute
+        minute = minute - minute % DASHBOARD_BUCKET_MINUTES
+        bucket = buckets.get(minute)
+        if bucket is None:
+            buckets[minute] = [1, temperature, temperature, temperature, humidity, humidity, humidity]
+        else:
+            bucket[0] = bucket[0] + 1
+            bucket[1] = min(bucket[1], temperature)
+            bucket[2] = bucket[2] + temperature
+            bucket[3] = max(bucket[3], temperature)
+            bucket[4] = min(bucket[4], humidity)
+            bucket[5] = bucket[5] + humidity
+            bucket[6] = max(bucket[6], humidity)
+
+    return {
+        "day": day,
+        "readings": readings,
+        "dropped": dropped,
+        "errors": errors,
+        "fan_on": fan_on,
+        "fan_known": fan_known,
+        "in_ideal": in_ideal,
+        "buckets": [[minute, bucket[0],
+                     round(bucket[1], 2), round(bucket[2] / bucket[0], 2), round(bucket[3], 2),
+                     round(bucket[4], 2), round(bucket[5] / bucket[0], 2), round(bucket[6], 2)]
+                    for minute, bucket in sorted(buckets.items())],
+    }
+
+
+def _write_json(path, value):
+    # Written to a temp file and renamed, so it is never half written
+    temp_path = path.with_name(path.name + '.tmp')
+    with open(temp_path, "w") as json_file:
+        json.dump(value, json_file)
+    os.replace(temp_path, path)
+
+
+def _read_json(path):
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return None
+
+
+def update_summaries(log_directory, dashboard_directory):
+    """
+    Brings the saved summaries up to date, only reading the days whose logs changed
+
+    :param log_directory: The directory with the daily logs
+    :param dashboard_directory: Where the dashboard and summaries are kept
+    :return: Every summary (including days no longer in the logs) sorted by day, and the number of days that were read
+    """
+    days_directory = dashboard_directory / 'days'
+    days_directory.mkdir(parents=True, exist_ok=True)
+
+    summaries = {}
+    for path in days_directory.glob("*.json"):
+        saved = _read_json(path)
+        if saved is not None and saved.get("version") == SUMMARY_VERSION:
+            summaries[path.stem] = saved
+
+    updated = 0
+    for day in log_store.log_days(log_directory):
+        signature = day_signature(day, log_directory)
+        saved = summaries.get(day)
+        if saved is not None and saved["signature"] == signature:
+            continue
+        summary = summarize_day(day, log_directory)
+        saved = {"version": SUMMARY_VERSION, "signature": signature, "summary": summary}
+        _write_json(days_directory / (day + ".json"), saved)
+        summaries[day] = saved
+        updated = updated + 1
+
+    return [summaries[day]["summary"] for day in sorted(summaries)], updated
+
+
+"""
+Disk usage
+"""
+
+
+def record_disk_usage(dashboard_directory, usb_directory):
+    """
+    Adds a free space sample to the history, if the last one is more than DASHBOARD_DISK_SAMPLE_MINUTES old
+
+    :return: The history, as a list of [time, total bytes, free bytes]
+    """
+    history_path = dashboard_directory / 'disk-usage.json'
+    history = _read_json(history_path) or []
+    now = datetime.today()
+    if history and now - datetime.fromisoformat(history[-1][0]) < timedelta(minutes=DASHBOARD_DISK_SAMPLE_MINUTES):
+        return history
+
+    try:
+        usage = shutil.disk_usage(usb_directory)
+    except OSError:
+        return history
+    history.append([now.isoformat(timespec='seconds'), usage.total, usage.free])
+    history = history[-DASHBOARD_DISK_SAMPLES:]
+    _write_json(history_path, history)
+    return history
+
+
+"""
+Charts
+"""
+
+
+def chart_series(summaries):
+    """
+    :return: Every bucket from the summaries as (time, readings, temp min, temp mean, temp max, humid min, humid mean,
+             humid max)
+    """
+    series = []
+    for summary in summaries:
+        start_of_day = datetime.strptime(summary["day"], '%Y%m%d')
+        for bucket in summary["buckets"]:
+            series.append((start_of_day + timedelta(minutes=bucket[0]),) + tuple(bucket[1:]))
+    return series
+
+
+def decimate(series, max_points=DASHBOARD_CHART_POINTS):
+    """
+    Merges neighbouring buckets together until there are at most max_points. The min is the min of the merged buckets,
+    the max the max and the mean is weighted by the number of readings, so no peaks are lost.
+
+    :param series: The buckets from chart_series
+    :return: The merged buckets, in the same format
+    """
+    if len(series) <= max_points:
+        return series
+    group = math.ceil(len(series) / max_points)
+    merged = []
+    for i in range(0, len(series), group):
+        chunk = series[i:i + group]
+        count = sum(bucket[1] for bucket in chunk)
+        merged.append((chunk[0][0], count,
+                       min(bucket[2] for bucket in chunk),
+                       sum(bucket[3] * bucket[1] for bucket in chunk) / count,
+                       max(bucket[4] for bucket in chunk),
+                       min(bucket[5] for bucket in chunk),
+                       sum(bucket[6] * bucket[1] for bucket in chunk) / count,
+                       max(bucket[7] for bucket in chunk)))
+    return merged
+
+
+def group_days(summaries, max_groups=DASHBOARD_BAR_GROUPS):
+    """
+    Adds up the day summaries into days, weeks or months, whichever is the smallest that gives at most max_groups
+
+    :param summaries: The day summaries, sorted by day
+    :return: List of (label, readings, fan on, fan known, [errors sensor 1, errors sensor 2])
+    """
+    groupings = [
+        lambda day: day.strftime('%Y-%m-%d'),
+        lambda day: "week of " + (day - timedelta(days=day.weekday())).strftime('%Y-%m-%d'),
+        lambda day: day.strftime('%Y-%m'),
+        lambda day: day.strftime('%Y'),
+    ]
+    for label_for in groupings:
+        labels = {label_for(datetime.strptime(summary["day"], '%Y%m%d')) for summary in summaries}
+        if len(labels) <= max_groups:
+            break
+
+    groups = {}
+    for summary in summaries:
+        label = label_for(datetime.strptime(summary["day"], '%Y%m%d'))
+        group = groups.setdefault(label, [label, 0, 0, 0, [0, 0]])
+        group[1] = group[1] + summary["readings"]
+        group[2] = group[2] + summary["fan_on"]
+        group[3] = group[3] + summary["fan_known"]
+        group[4] = [group[4][0] + summary["errors"][0], group[4][1] + summary["errors"][1]]
+    return [tuple(groups[label]) for label in sorted(groups)]
+
+
+def _segments(times, max_step):
+    # Splits the points wherever there is a gap in time, so the lines aren't drawn across days with no logs
+    segments = []
+    for i, time_value in enumerate(times):
+        if not segments or time_value - times[i - 1] > max_step:
+            segments.append([])
+        segments[-1].append(i)
+    return segments
+
+
+def svg_line_chart(times, means, lows=None, highs=None, ideal=None, unit="", color="#1f77b4"):
+    """
+    Line chart over time, with an optional min/max band and an optional shaded ideal range
+
+    :param times: datetimes of each point, sorted
+    :param means: The value of each point
+    :param lows: The min of each point, drawn as a band with highs
+    :param highs: The max of each point
+    :param ideal: (lower, upper) range to shade
+    :param unit: Shown after the values on the axis
+    :return: The chart as an SVG string
+    """
+    if not times:
+        return "<p>No data yet</p>"
+    lows = lows or means
+    highs = highs or means
+    low = min(lows)
+    high = max(highs)
+    if ideal is not None:
+        low = min(low, ideal[0])
+        high = max(high, ideal[1])
+    if high == low:
+        high = low + 1
+    start = times[0]
+    span = max((times[-1] - start).total_seconds(), 1)
+    plot_width = CHART_WIDTH - 2 * CHART_MARGIN
+    plot_height = CHART_HEIGHT - 2 * CHART_MARGIN
+
+    def x(time_value):
+        return CHART_MARGIN + (time_value - start).total_seconds() / span * plot_width
+
+    def y(value):
+        return CHART_MARGIN + (high - value) / (high - low) * plot_height
+
+    parts = [f'<svg width="{CHART_WIDTH}" height="{CHART_HEIGHT}" xmlns="http://www.w3.org/2000/svg">',
+             f'<rect x="{CHART_MARGIN}" y="{CHART_MARGIN}" width="{plot_width}" height="{plot_height}" '
+             f'fill="none" stroke="#ccc"/>']
+    if ideal is not None:
+        parts.append(f'<rect x="{CHART_MARGIN}" y="{y(ideal[1]):.1f}" width="{plot_width}" '
+                     f'height="{y(ideal[0]) - y(ideal[1]):.1f}" fill="#2ca02c" fill-opacity="0.15"/>')
+
+    # A gap of more than 3 times the usual step between points is a gap in the data
+    steps = sorted((times[i + 1] - times[i]) for i in range(len(times) - 1))
+    max_step = steps[len(steps) // 2] * 3 if steps else timedelta(0)
+    for segment in _segments(times, max_step):
+        if lows is not means:
+            band = ([f"{x(times[i]):.1f},{y(highs[i]):.1f}" for i in segment] +
+                    [f"{x(times[i]):.1f},{y(lows[i]):.1f}" for i in reversed(segment)])
+            parts.append(f'<polygon points="{" ".join(band)}" fill="{color}" fill-opacity="0.2"/>')
+        line = " ".join(f"{x(times[i]):.1f},{y(means[i]):.1f}" for i in segment)
+        parts.append(f'<polyline points="{line}" fill="none" stroke="{color}" stroke-width="1.5"/>')
+
+    parts.append(f'<text x="2" y="{CHART_MARGIN + 4}" font-size="11">{high:.1f}{unit}</text>')
+    parts.append(f'<text x="2" y="{CHART_HEIGHT - CHART_MARGIN + 4}" font-size="11">{low:.1f}{unit}</text>')
+    parts.append(f'<text x="{CHART_MARGIN}" y="{CHART_HEIGHT - 10}" font-size="11">'
+                 f'{times[0].strftime("%Y-%m-%d %H:%M")}</text>')
+    parts.append(f'<text x="{CHART_WIDTH - CHART_MARGIN}" y="{CHART_HEIGHT - 10}" font-size="11" text-anchor="end">'
+                 f'{times[-1].strftime("%Y-%m-%d %H:%M")}</text>')
+    parts.append('</svg>')
+    return "\n".join(parts)
+
+
+def svg_bar_chart(labels, series, max_value=100, unit="%"):
+    """
+    Bar chart with one group of bars per label
+
+    :param labels: Label of each group (shown for the first and last)
+    :param series: List of (name, color, values), one bar in each group for each
+    :param max_value: Value at the top of the chart
+    :return: The chart as an SVG string
+    """
+    if not labels:
+        return "<p>No data yet</p>"
+    plot_width = CHART_WIDTH - 2 * CHART_MARGIN
+    plot_height = CHART_HEIGHT - 2 * CHART_MARGIN
+    group_width = plot_width / len(labels)
+    bar_width = group_width * 0.8 / len(series)
+
+    parts = [f'<svg width="{CHART_WIDTH}" height="{CHART_HEIGHT}" xmlns="http://www.w3.org/2000/svg">',
+             f'<rect x="{CHART_MARGIN}" y="{CHART_MARGIN}" width="{plot_width}" height="{plot_height}" '
+             f'fill="none" stroke="#ccc"/>']
+    for s, (name, color, values) in enumerate(series):
+        for i, value in enumerate(values):
+            height = min(value, max_value) / max_value * plot_height
+            parts.append(f'<rect x="{CHART_MARGIN + i * group_width + s * bar_width:.1f}" '
+                         f'y="{CHART_MARGIN + plot_height - height:.1f}" width="{max(bar_width, 0.5):.1f}" '
+                         f'height="{height:.1f}" fill="{color}"><title>{html.escape(labels[i])} {html.escape(name)}: '
+                         f'{value:.1f}{unit}</title></rect>')
+        parts.append(f'<text x="{CHART_WIDTH - CHART_MARGIN}" y="{CHART_MARGIN - 8 - 14 * s}" font-size="11" '
+                     f'text-anchor="end" fill="{color}">{html.escape(name)}</text>')
+
+    parts.append(f'<text x="2" y="{CHART_MARGIN + 4}" font-size="11">{max_value}{unit}</text>')
+    parts.append(f'<text x="2" y="{CHART_HEIGHT - CHART_MARGIN + 4}" font-size="11">0{unit}</text>')
+    parts.append(f'<text x="{CHART_MARGIN}" y="{CHART_HEIGHT - 10}" font-size="11">{html.escape(labels[0])}</text>')
+    parts.append(f'<text x="{CHART_WIDTH - CHART_MARGIN}" y="{CHART_HEIGHT - 10}" font-size="11" text-anchor="end">'
+                 f'{html.escape(labels[-1])}</text>')
+    parts.append('</svg>')
+    return "\n".join(parts)
+
+
+"""
+Page
+"""
+
+
+def latest_thumbnail(index_root):
+    """
+    :param index_root: The capture index (see capture_index.py)
+    :return: (hour folder, picture name, jpeg bytes) of the newest contact sheet tile, or None if there are none
+    """
+    if not index_root.is_dir():
+        return None
+    for index_directory in sorted(index_root.iterdir(), reverse=True):
+        thumbnails = sorted((index_directory / 'tiles').glob("image_*.jpg"))
+        if thumbnails:
+            return index_directory.name, thumbnails[-1].name, thumbnails[-1].read_bytes()
+    return None
+
+
+def _percent(part, whole):
+    return 100 * part / whole if whole else 0
+
+
+def day_totals(summary):
+    """
+    :return: The min/mean/max temperature and humidity for the whole day, or None if there were no good readings
+    """
+    buckets = summary["buckets"]
+    count = sum(bucket[1] for bucket in buckets)
+    if not count:
+        return None
+    return {
+        "temp_min": min(bucket[2] for bucket in buckets),
+        "temp_mean": sum(bucket[3] * bucket[1] for bucket in buckets) / count,
+        "temp_max": max(bucket[4] for bucket in buckets),
+        "humid_min": min(bucket[5] for bucket in buckets),
+        "humid_mean": sum(bucket[6] * bucket[1] for bucket in buckets) / count,
+        "humid_max": max(bucket[7] for bucket in buckets),
+    }
+
+
+def render_page(summaries, disk_history, thumbnail):
+    """
+    :param summaries: The day summaries, sorted by day
+    :param disk_history: The disk usage history from record_disk_usage
+    :param thumbnail: The latest thumbnail from latest_thumbnail, or None
+    :return: The page as an HTML string
+    """
+    series = decimate(chart_series(summaries))
+    times = [bucket[0] for bucket in series]
+    temperature_chart = svg_line_chart(times, [b[3] for b in series], [b[2] for b in series], [b[4] for b in series],
+                                       (crab_library.IDEAL_TEMP_LOWER_LIMIT, crab_library.IDEAL_TEMP_UPPER_LIMIT),
+                                       "F", "#d62728")
+    humidity_chart = svg_line_chart(times, [b[6] for b in series], [b[5] for b in series], [b[7] for b in series],
+                                    (crab_library.IDEAL_HUMID_LOWER_LIMIT, crab_library.IDEAL_HUMID_UPPER_LIMIT),
+                                    "%", "#1f77b4")
+
+    groups = group_days(summaries)
+    labels = [group[0] for group in groups]
+    fan_chart = svg_bar_chart(labels, [("fan on", "#9467bd", [_percent(g[2], g[3]) for g in groups])])
+    error_chart = svg_bar_chart(labels, [
+        ("sensor 1", "#ff7f0e", [_percent(g[4][0], g[1]) for g in groups]),
+        ("sensor 2", "#8c564b", [_percent(g[4][1], g[1]) for g in groups]),
+    ])
+
+    # Free space changes slowly, so every Nth sample is enough
+    disk_history = disk_history[::math.ceil(len(disk_history) / DASHBOARD_CHART_POINTS) or 1]
+    gigabyte = 1024 ** 3
+    disk_chart = svg_line_chart([datetime.fromisoformat(sample[0]) for sample in disk_history],
+                                [sample[2] / gigabyte for sample in disk_history],
+                                ideal=(crab_library.SPACE_THRESHOLD_KB * 1024 / gigabyte,
+                                       disk_history[-1][1] / gigabyte) if disk_history else None,
+                                unit="GB", color="#7f7f7f")
+
+    if thumbnail is not None:
+        hour, name, data = thumbnail
+        thumbnail_html = (f'<img src="data:image/jpeg;base64,{base64.b64encode(data).decode("ascii")}">'
+                          f'<p>{html.escape(hour)} {html.escape(name)}</p>')
+    else:
+        thumbnail_html = "<p>No captures indexed yet</p>"
+
+    rows = []
+    for summary in reversed(summaries[-DASHBOARD_TABLE_DAYS:]):
+        totals = day_totals(summary)
+        readings = summary["readings"]
+        if totals is None:
+            values = '<td colspan="2">no good readings</td>'
+        else:
+            values = (f'<td>{totals["temp_min"]:.1f} / {totals["temp_mean"]:.1f} / {totals["temp_max"]:.1f}</td>'
+                      f'<td>{totals["humid_min"]:.1f} / {totals["humid_mean"]:.1f} / {totals["humid_max"]:.1f}</td>')
+        rows.append(f'<tr><td>{summary["day"]}</td><td>{readings}</td>{values}'
+                    f'<td>{_percent(summary["in_ideal"], readings):.0f}%</td>'
+                    f'<td>{_percent(summary["fan_on"], summary["fan_known"]):.0f}%</td>'
+                    f'<td>{_percent(summary["errors"][0], readings):.1f}% / '
+                    f'{_percent(summary["errors"][1], readings):.1f}%</td>'
+                    f'<td>{summary["dropped"]}</td></tr>')
+
+    return f"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Hermit Crab Tank</title>
+<style>
+body {{ font-family: sans-serif; margin: 20px; }}
+table {{ border-collapse: collapse; }}
+td, th {{ border: 1px solid #ccc; padding: 3px 8px; text-align: right; }}
+</style>
+</head>
+<body>
+<h1>Hermit Crab Tank</h1>
+<p>Generated {datetime.today().strftime('%Y-%m-%d %H:%M')}, {len(summaries)} days of logs</p>
+<h2>Latest capture</h2>
+{thumbnail_html}
+<h2>Temperature (F)</h2>
+{temperature_chart}
+<h2>Humidity (%)</h2>
+{humidity_chart}
+<h2>Fan duty cycle</h2>
+{fan_chart}
+<h2>Sensor error rate</h2>
+{error_chart}
+<h2>Free space on the USB drive</h2>
+{disk_chart}
+<h2>Recent days</h2>
+<table>
+<tr><th>Day</th><th>Readings</th><th>Temp min/mean/max</th><th>Humid min/mean/max</th><th>In ideal range</th>
+<th>Fan on</th><th>Errors sensor 1/2</th><th>Readings dropped</th></tr>
+{chr(10).join(rows)}
+</table>
+</body>
+</html>
+"""
+
+
+def update_dashboard(log_directory=crab_library.TEMP_HUMID_PARENT_LOCATION,
+                     index_root=crab_library.CAPTURE_INDEX_LOCATION,
+                     dashboard_directory=crab_library.DASHBOARD_LOCATION,
+                     usb_directory=crab_library.USB_DIRECTORY):
+    """
+    Brings the summaries up to date and writes the dashboard page
+
+    :return: The number of days that were read
+    """
+    summaries, updated = update_summaries(log_directory, dashboard_directory)
+    disk_history = record_disk_usage(dashboard_directory, usb_directory)
+    page = render_page(summaries, disk_history, latest_thumbnail(index_root))
+
+    temp_path = dashboard_directory / 'index.html.tmp'
+    with open(temp_path, "w") as page_file:
+        page_file.write(page)
+    os.replace(temp_path, dashboard_directory / 'index.html')
+    return updated
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--watch", action="store_true",
+                        help=f"Keep running, updating the dashboard every {DASHBOARD_INTERVAL_SECONDS} seconds")
+    parser.add_argument("--logs", type=Path, default=crab_library.TEMP_HUMID_PARENT_LOCATION,
+                        help="The temp/humid log directory")
+    parser.add_argument("--index", type=Path, default=crab_library.CAPTURE_INDEX_LOCATION,
+                        help="The capture index, for the latest thumbnail")
+    parser.add_argument("--output", type=Path, default=crab_library.DASHBOARD_LOCATION,
+                        help="Where to write the dashboard and keep the summaries")
+    parser.add_argument("--usb", type=Path, default=crab_library.USB_DIRECTORY,
+                        help="The drive to record the free space of")
+    return parser.parse_args()
+
+
+def main(args):
+    def update():
+        updated = update_dashboard(args.logs, args.index, args.output, args.usb)
+        crab_library.print_log(f"DASHBOARD: Updated, {updated} days read", 2)
+
+    crab_library.run_watch(update, DASHBOARD_INTERVAL_SECONDS, args.watch,
+                           "DASHBOARD-ERROR: Issue while updating the dashboard")
+
+
+if __name__ == "__main__":
+    main(arg_parser())
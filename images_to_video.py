@@ -22,17 +22,32 @@ Things that may need to change depending on setup
     - The Directory naming convention, should that ever change
     - The 180-degree rotation, since the camera is currently mounted upside down
 
+The hour can be a folder of pictures or a container file (see capture_container.py), the pictures are read straight out
+of the container without extracting them.
+
+With --overlay, the temperature, humidity, fan and heat lamp status from the temp-humid-logs nearest to when each
+picture was taken is shown along the bottom of the video. The pictures and the log readings are both already in time
+order, so they are matched up in a single pass over both, without loading the logs into memory.
+
 """
+from datetime import timedelta
 from pathlib import Path
 import cv2
-import glob
+import numpy
 import argparse
+import log_store
+
+from capture_container import CONTAINER_SUFFIX, open_hour
 
 # Constants for the video dimensions
 DEFAULT_VIDEO_HEIGHT = 1280
 DEFAULT_VIDEO_WIDTH = 720
 USB_DRIVE_NUMBER = 'F'
 
+# Constants for the --overlay option, log readings further than OVERLAY_MAX_DISTANCE from a picture are not shown
+OVERLAY_MAX_DISTANCE = timedelta(seconds=30)
+OVERLAY_BAR_HEIGHT = 40
+
 
 def arg_parser():
     """
@@ -46,47 +61,139 @@ def arg_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("capture_folder_number",
                         help="The name in integer format of the folder in the captures directory to turn into video")
+    parser.add_argument("--overlay", action="store_true",
+                        help="Burn the temperature, humidity, fan and heat lamp status at each picture into the video")
+    parser.add_argument("--logs", default=f"{USB_DRIVE_NUMBER}:/temp-humid-logs",
+                        help="The temp-humid-logs directory to use for --overlay")
     return parser.parse_args()
 
 
-def main(args):
-    # Format directory and ensure it exist (auto fill usb directory and captures based on expected format
-    usb_directory = f"{USB_DRIVE_NUMBER}:/captures/{args.capture_folder_number}/*"
-    if not Path(usb_directory[:-1]).is_dir():
-        print("Provided directory [%s] does not exist!", usb_directory)
-        raise AssertionError
+def nearest_records(times, records, max_distance=OVERLAY_MAX_DISTANCE):
+    """
+    Matches each time to the nearest log record, in one pass over both. Both have to be in order, which the pictures
+    and the logs already are. Only the records on either side of the current time are held at once, so this never
+    loads a whole day of logs.
+
+    :param times: Sorted datetimes to match
+    :param records: Sorted LogRecords (i.e. from log_store.iter_records)
+    :param max_distance: timedelta, records further away than this are not matched
+    :return: generator of the nearest LogRecord for each time, or None if there isn't one close enough
+    """
+    records = (record for record in records if record.gap is None)
+    before = None
+    after = next(records, None)
+    for time in times:
+        # Move forward until "after" is the first record past this time
+        while after is not None and after.timestamp <= time:
+            before = after
+            after = next(records, None)
+
+        nearest = None
+        for record in (before, after):
+            if record is not None and abs(record.timestamp - time) <= max_distance:
+                if nearest is None or abs(record.timestamp - time) < abs(nearest.timestamp - time):
+                    nearest = record
+        yield nearest
+
+
+def _average(first, second):
+    values = [value for value in (first, second) if value is not None]
+    if not values:
+        return None
+    return sum(values) / len(values)
+
+
+def overlay_text(time, record):
+    """
+    :return: The text shown on a picture, for the time it was taken and the nearest log record
+    """
+    text = time.strftime('%Y-%m-%d %H:%M:%S')
+    if record is None:
+        return text + "  no reading"
+
+    temperature = _average(record.temperature_1, record.temperature_2)
+    humidity = _average(record.humidity_1, record.humidity_2)
+    text = text + ("  --F" if temperature is None else f"  {temperature:.1f}F")
+    text = text + ("  --%" if humidity is None else f"  {humidity:.1f}%")
+    text = text + f"  fan {record.fan_status or '--'}  heat {record.heat_lamp_status or '--'}"
+    return text
+
+
+def draw_overlay(img, text):
+    """
+    Draws the text in a dark bar along the bottom of the picture
+    """
+    height, width, layers = img.shape
+    cv2.rectangle(img, (0, height - OVERLAY_BAR_HEIGHT), (width, height), (0, 0, 0), -1)
+    cv2.putText(img, text, (10, height - 12), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2, cv2.LINE_AA)
+
+
+def render_video(directory, output_name, log_directory=None):
+    """
+    Turns a directory of images into a video. Each picture is written to the video as soon as it is read, so only one
+    picture is in memory at a time.
+
+    :param directory: The directory with the pictures, ending with a "/", or a container file
+    :param output_name: The name of the video file to create
+    :param log_directory: If given, the temp-humid-logs directory to get the readings to overlay on each picture
+    """
+    # Only the pictures, in the order they were taken (folders can also have a gaps.txt from the spool)
+    pictures = open_hour(Path(directory))
+    filenames = pictures.names()
+
+    readings = None
+    if log_directory is not None and filenames:
+        # The time saved in the container (or worked out for a folder), not the hour's name plus the picture name, as
+        # the first pictures of an hour can be filed with the hour before
+        times = [pictures.taken(filename) for filename in filenames]
+        records = log_store.iter_records(Path(log_directory), times[0] - OVERLAY_MAX_DISTANCE,
+                                         times[-1] + OVERLAY_MAX_DISTANCE)
+        readings = zip(times, nearest_records(times, records))
 
     # Attempt the to turn the directory of images into a video
-    size = (DEFAULT_VIDEO_HEIGHT, DEFAULT_VIDEO_WIDTH)
-    img_array = []
-    try:
-        print("Processing...")
-        for filename in glob.glob(usb_directory):
-            img = cv2.imread(filename)
+    out = None
+    print("Processing...")
+    for filename in filenames:
+        reading = next(readings) if readings is not None else None
+        data = pictures.read(filename)
+        img = cv2.imdecode(numpy.frombuffer(data, numpy.uint8), cv2.IMREAD_COLOR) if data is not None else None
+        if img is None:
+            print(f"File most likely corrupted {filename}")
+            continue
+
+        if out is None:
             height, width, layers = img.shape
-            size = (width, height)
-            # rotate 180 (camera mounted upside down atm
-            img = cv2.rotate(img, cv2.ROTATE_180)
-            img_array.append(img)
-
-    except Exception as e:
-        print(f"File most likely corrupted {filename}")
+            out = cv2.VideoWriter(output_name, cv2.VideoWriter_fourcc(*'DIVX'), 15, (width, height))
 
-    # Output the video
-    out = cv2.VideoWriter(f"project_{args.capture_folder_number}.avi", cv2.VideoWriter_fourcc(*'DIVX'), 15, size)
+        # rotate 180 (camera mounted upside down atm
+        img = cv2.rotate(img, cv2.ROTATE_180)
+        if reading is not None:
+            draw_overlay(img, overlay_text(*reading))
+        out.write(img)
 
-    print(f"Video project_{args.capture_folder_number}.avi completed")
     print("Releasing...")
-
-    for i in range(len(img_array)):
-        out.write(img_array[i])
-    out.release()
+    pictures.close()
+    if out is not None:
+        out.release()
+        print(f"Video {output_name} completed")
 
     print("Done!")
 
 
-args = arg_parser()
-main(args)
+def main(args):
+    # Format directory and ensure it exist (auto fill usb directory and captures based on expected format
+    # The hour's container file is used if there is one, otherwise the hour folder
+    usb_directory = f"{USB_DRIVE_NUMBER}:/captures/{args.capture_folder_number}/"
+    container = f"{USB_DRIVE_NUMBER}:/captures/{args.capture_folder_number}{CONTAINER_SUFFIX}"
+    if Path(container).is_file():
+        usb_directory = container
+    elif not Path(usb_directory).is_dir():
+        print("Provided directory [%s] does not exist!", usb_directory)
+        raise AssertionError
 
+    render_video(usb_directory, f"project_{args.capture_folder_number}.avi", args.logs if args.overlay else None)
 
 
+if __name__ == "__main__":
+    args = arg_parser()
+    main(args)
@@ -0,0 +1,395 @@
+"""
+Joel Yuhas
+Raspberry-Pi/Hermit Crab project
+
+-------------------------------------------------------------------------------------
+log_shipper.py
+-------------------------------------------------------------------------------------
+
+Ships new log data off the pi, replacing the git add/commit/push of the output logs on every boot.
+
+The shipper keeps track of what it has already shipped from each source. Each run, only the new data is read,
+compressed and put into dated bundles ("hermitcrab-YYYYMMDD-HHMMSS-<number>.tar.gz"), which are delivered to a
+destination. Sources shipped:
+    - The daily temp/humid logs on the USB drive. These are read line by line through log_store, and the shipper keeps
+      a watermark for each day (the timestamp of the last line shipped, and the lines with that timestamp). Byte
+      offsets can't be used, as log_store.compress_log sorts, merges and de-duplicates the whole day, so the same
+      reading is at a different byte after compression. Lines added earlier than the watermark (only if the clock was
+      set back) are not shipped.
+    - The program output logs in logs/output_*.txt, which are only added to, by byte offset
+
+Each bundle has a manifest.json, plus one file per piece of data:
+    - Temp/humid logs:  "<source>.<first timestamp>-<last timestamp>", adding the pieces on in order gives every
+                        reading of the day once, in time order (the same lines as the compressed log)
+    - Program logs:     "<source>.<start byte>-<end byte>", adding the pieces on in order gives the original file
+
+Shipping is done in the following order, so it can be stopped at any point (power loss, etc.) and resumes exactly where
+it left off, without losing or repeating any data:
+    1. The bundle is written to the state directory
+    2. The state is saved with the bundle marked as pending
+    3. The bundle is delivered (delivering the same bundle twice just replaces it)
+    4. The state is saved with the new offsets and watermarks, and the bundle is removed
+
+The shipper reads at most SHIPPER_MAX_BYTES_PER_SECOND and runs at a lower priority, so it never competes with the
+capture programs for the USB drive.
+
+Destinations are classes with a deliver(path, name) method, DirectoryDestination copies the bundles into a directory
+(a mounted network share, a second drive, etc.). The directory must be a mount point, so bundles are never delivered to
+the empty mount point on the SD card while the share is not mounted.
+
+Offsets, watermarks and signatures of sources that no longer exist (days removed by check_space) are dropped from the
+state, so the state file doesn't keep growing.
+
+"""
+import argparse
+import io
+import json
+import os
+import shutil
+import tarfile
+import time
+import crab_library
+import log_store
+
+from datetime import datetime
+from pathlib import Path
+
+
+PROJECT_LOG_DIRECTORY = Path(__file__).resolve().parent / 'logs'
+READ_CHUNK_BYTES = 64 * 1024
+
+
+class DirectoryDestination:
+    """
+    Delivers bundles by copying them into a directory. The copy is made under a temporary name and renamed once
+    complete, so a partly copied bundle never shows up under its real name.
+    """
+    def __init__(self, directory, require_mount=True):
+        """
+        :param directory: The directory to copy the bundles into
+        :param require_mount: True if the directory must be a mount point (see crab_library.usb_ready)
+        """
+        self.directory = directory
+        self.require_mount = require_mount
+
+    def deliver(self, path, name):
+        if self.require_mount and not os.path.ismount(self.directory):
+            raise OSError(f"Destination directory is not mounted: {self.directory}")
+        if not self.directory.is_dir() or not os.access(self.directory, os.W_OK):
+            raise OSError(f"Destination directory does not exist or is not writable: {self.directory}")
+        temp_path = self.directory / ('.' + name + '.partial')
+        with open(path, "rb") as bundle_file, open(temp_path, "wb") as out_file:
+            shutil.copyfileobj(bundle_file, out_file)
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        os.replace(temp_path, self.directory / name)
+
+
+class Throttle:
+    """
+    Keeps the average read rate under max_bytes_per_second by sleeping
+    """
+    def __init__(self, max_bytes_per_second):
+        self.max_bytes_per_second = max_bytes_per_second
+        self.start = time.monotonic()
+        self.total = 0
+
+    def add(self, count):
+        self.total = self.total + count
+        ahead = self.total / self.max_bytes_per_second - (time.monotonic() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def list_sources(temp_humid_directory, project_log_directory):
+    """
+    :return: Dictionary of source name -> list of paths that make up the source, read one after another
+    """
+    sources = {}
+    if temp_humid_directory.is_dir():
+        for day in log_store.log_days(temp_humid_directory):
+            sources[f"temp-humid-logs/{day}.txt"] = log_store.day_log_paths(day, temp_humid_directory)
+    if project_log_directory.is_dir():
+        for path in sorted(project_log_directory.glob("output_*.txt")):
+            sources[f"logs/{path.name}"] = [path]
+    return sources
+
+
+def _compact(timestamp):
+    # "2022-07-13-14:05:09" -> "20220713140509", the ":" isn't allowed in file names on the FAT formatted drives
+    return "".join(character for character in timestamp if character.isdigit())
+
+
+def signature(paths):
+    """
+    :return: The names, sizes and modified times of the paths, if this is the same as the last run nothing changed
+    """
+    signature = []
+    for path in paths:
+        stat = path.stat()
+        signature.append([path.name, stat.st_size, stat.st_mtime])
+    return signature
+
+
+def read_from(paths, offset, limit, throttle):
+    """
+    Reads up to limit bytes, starting at offset, from the paths one after another. Compressed files can't be seeked
+    into, so they are read through up to the offset.
+
+    :return: The bytes read
+    """
+    data = bytearray()
+    # Position in the combined data at the start of the current file
+    position = 0
+    for path in paths:
+        if len(data) >= limit:
+            break
+        compressed = path.name.endswith(".gz")
+        if not compressed:
+            size = path.stat().st_size
+            if position + size <= offset:
+                position = position + size
+                continue
+
+        with log_store.open_log(path, binary=True) as source_file:
+            if not compressed and offset > position:
+                source_file.seek(offset - position)
+                position = offset
+            while len(data) < limit:
+                chunk = source_file.read(READ_CHUNK_BYTES)
+                if not chunk:
+                    break
+                throttle.add(len(chunk))
+                skip = max(offset - position, 0)
+                data.extend(chunk[skip:skip + limit - len(data)])
+                position = position + len(chunk)
+    return bytes(data)
+
+
+def read_day_from(day, directory, watermark, limit, throttle):
+    """
+    Reads up to limit bytes of the day's log lines after the watermark
+
+    :param day: The day in "YYYYMMDD" format
+    :param directory: The directory with the daily logs
+    :param watermark: [timestamp of the last line shipped, the lines with that timestamp already shipped], or None
+    :return: The bytes read, the new watermark, and True if everything was read
+    """
+    data = bytearray()
+    last, shipped = watermark if watermark is not None else (None, [])
+    start = None
+    if last is not None:
+        try:
+            start = log_store.parse_timestamp(last)
+        except ValueError:
+            pass
+
+    for line in log_store.iter_day_lines(day, directory, start):
+        throttle.add(len(line))
+        # Still being written, it is shipped once it is whole
+        if not line.endswith("\n"):
+            break
+        timestamp = line[:19]
+        # Lines at the watermark's timestamp are told apart by what they say, the same as compress_log only keeps one
+        # of lines that are exactly the same
+        if last is not None and (timestamp < last or (timestamp == last and line in shipped)):
+            continue
+
+        encoded = line.encode()
+        if data and len(data) + len(encoded) > limit:
+            return bytes(data), [last, shipped], False
+        data.extend(encoded)
+        if timestamp == last:
+            shipped = shipped + [line]
+        else:
+            last, shipped = timestamp, [line]
+    return bytes(data), [last, shipped] if last is not None else None, True
+
+
+class LogShipper:
+    """
+    Keeps the shipping state (offsets, watermarks, signatures and any pending bundle) in state.json in the state
+    directory, and ships the new data from each source to the destination.
+    """
+    def __init__(self, destination, state_directory=crab_library.SHIPPER_STATE_DIRECTORY,
+                 temp_humid_directory=crab_library.TEMP_HUMID_PARENT_LOCATION,
+                 project_log_directory=PROJECT_LOG_DIRECTORY,
+                 max_bundle_bytes=crab_library.SHIPPER_MAX_BUNDLE_BYTES,
+                 max_bytes_per_second=crab_library.SHIPPER_MAX_BYTES_PER_SECOND):
+        self.destination = destination
+        self.state_directory = state_directory
+        self.state_path = state_directory / 'state.json'
+        self.temp_humid_directory = temp_humid_directory
+        self.project_log_directory = project_log_directory
+        self.max_bundle_bytes = max_bundle_bytes
+        self.max_bytes_per_second = max_bytes_per_second
+
+        self.state_directory.mkdir(parents=True, exist_ok=True)
+        self.state = {"offsets": {}, "watermarks": {}, "signatures": {}, "sequence": 0, "pending": None}
+        if self.state_path.exists():
+            with open(self.state_path) as state_file:
+                self.state = json.load(state_file)
+
+    def save_state(self):
+        temp_path = self.state_path.with_suffix('.tmp')
+        with open(temp_path, "w") as state_file:
+            json.dump(self.state, state_file)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.replace(temp_path, self.state_path)
+
+    def finish_pending(self):
+        """
+        Delivers and commits the pending bundle, if the last run was stopped partway through. Also removes any bundle
+        that was written but never marked as pending.
+        """
+        pending = self.state["pending"]
+        for path in self.state_directory.glob("*.tar.gz*"):
+            if pending is None or path.name != pending["bundle"]:
+                path.unlink()
+
+        if pending is None:
+            return
+        bundle_path = self.state_directory / pending["bundle"]
+        self.destination.deliver(bundle_path, pending["bundle"])
+        self.state["offsets"].update(pending["offsets"])
+        self.state["watermarks"].update(pending["watermarks"])
+        self.state["signatures"].update(pending["signatures"])
+        self.state["pending"] = None
+        self.save_state()
+        bundle_path.unlink()
+        crab_library.print_log(f"SHIPPER: Delivered {pending['bundle']}", 1)
+
+    def forget_missing(self, sources):
+        """
+        Drops the offsets, watermarks and signatures of sources that no longer exist. Only done for a directory that is
+        there, otherwise an unplugged USB drive would look like every log was deleted, and they would all be shipped
+        again.
+
+        :param sources: The sources from list_sources
+        """
+        readable = [prefix for prefix, directory in (("temp-humid-logs/", self.temp_humid_directory),
+                                                      ("logs/", self.project_log_directory)) if directory.is_dir()]
+        for key in ("offsets", "watermarks", "signatures"):
+            for source in list(self.state[key]):
+                if source not in sources and source.startswith(tuple(readable)):
+                    del self.state[key][source]
+
+    def make_bundle(self, throttle):
+        """
+        Reads the new data from every source, up to max_bundle_bytes, and writes it into a bundle
+
+        :return: The pending entry for the bundle, or None if there was no new data
+        """
+        # (bundle file name, manifest entry, data)
+        pieces = []
+        offsets = {}
+        watermarks = {}
+        signatures = {}
+        total = 0
+        sources = list_sources(self.temp_humid_directory, self.project_log_directory)
+        self.forget_missing(sources)
+        for source, paths in sources.items():
+            if total >= self.max_bundle_bytes:
+                break
+            source_signature = signature(paths)
+            if self.state["signatures"].get(source) == source_signature:
+                continue
+
+            limit = self.max_bundle_bytes - total
+            if source.startswith("temp-humid-logs/"):
+                data, watermark, complete = read_day_from(source[16:24], self.temp_humid_directory,
+                                                          self.state["watermarks"].get(source), limit, throttle)
+                if data:
+                    first = data[:19].decode(errors="replace")
+                    pieces.append((f"{source}.{_compact(first)}-{_compact(watermark[0])}",
+                                   {"source": source, "first": first, "last": watermark[0]}, data))
+                watermarks[source] = watermark
+            else:
+                offset = self.state["offsets"].get(source, 0)
+                if paths[0].stat().st_size < offset:
+                    # File was replaced or truncated, start it over
+                    crab_library.print_log(f"SHIPPER: {source} is smaller than before, shipping from the start", 1)
+                    offset = 0
+                data = read_from(paths, offset, limit, throttle)
+                complete = len(data) < limit
+                if data:
+                    pieces.append((f"{source}.{offset}-{offset + len(data)}",
+                                   {"source": source, "start": offset, "end": offset + len(data)}, data))
+                offsets[source] = offset + len(data)
+
+            total = total + len(data)
+            # Only mark as caught up once everything was read, otherwise the next bundle carries on from there
+            if complete:
+                signatures[source] = source_signature
+
+        if not pieces:
+            # Nothing new, but remember the signatures so the files are not read again next time
+            self.state["signatures"].update(signatures)
+            self.state["offsets"].update(offsets)
+            self.state["watermarks"].update(watermarks)
+            self.save_state()
+            return None
+
+        self.state["sequence"] = self.state["sequence"] + 1
+        name = f"hermitcrab-{datetime.today().strftime('%Y%m%d-%H%M%S')}-{self.state['sequence']:06d}.tar.gz"
+        manifest = {
+            "created": datetime.today().strftime('%Y-%m-%d-%H:%M:%S'),
+            "pieces": [entry for _, entry, _ in pieces],
+        }
+
+        temp_path = self.state_directory / (name + '.tmp')
+        with tarfile.open(temp_path, "w:gz") as bundle:
+            for member_name, data in [("manifest.json", json.dumps(manifest, indent=2).encode())] + [
+                    (member_name, data) for member_name, _, data in pieces]:
+                info = tarfile.TarInfo(member_name)
+                info.size = len(data)
+                info.mtime = time.time()
+                bundle.addfile(info, io.BytesIO(data))
+        os.replace(temp_path, self.state_directory / name)
+        return {"bundle": name, "offsets": offsets, "watermarks": watermarks, "signatures": signatures}
+
+    def ship(self):
+        """
+        Ships everything new, in as many bundles as needed
+
+        :return: The number of bundles delivered
+        """
+        self.finish_pending()
+        throttle = Throttle(self.max_bytes_per_second)
+        delivered = 0
+        while True:
+            pending = self.make_bundle(throttle)
+            if pending is None:
+                return delivered
+            self.state["pending"] = pending
+            self.save_state()
+            self.finish_pending()
+            delivered = delivered + 1
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--destination", type=Path, default=crab_library.SHIPPER_DESTINATION,
+                        help="Directory to deliver the bundles to")
+    parser.add_argument("--not-mounted", action="store_true",
+                        help="Allow a destination that is a plain directory instead of a mount point")
+    parser.add_argument("--watch", action="store_true",
+                        help=f"Keep running, shipping new data every {crab_library.SHIPPER_INTERVAL_SECONDS} seconds")
+    return parser.parse_args()
+
+
+def main(args):
+    shipper = LogShipper(DirectoryDestination(args.destination, not args.not_mounted))
+
+    def ship():
+        delivered = shipper.ship()
+        crab_library.print_log(f"SHIPPER: Delivered {delivered} bundles", 2)
+
+    # A destination that is not mounted, no network, etc. is logged, and any pending bundle is delivered on the next try
+    crab_library.run_watch(ship, crab_library.SHIPPER_INTERVAL_SECONDS, args.watch,
+                           "SHIPPER-ERROR: Issue while shipping logs")
+
+
+if __name__ == "__main__":
+    main(arg_parser())
@@ -0,0 +1,390 @@
+"""
+Joel Yuhas
+Raspberry-Pi/Hermit Crab project
+
+-------------------------------------------------------------------------------------
+log_store.py
+-------------------------------------------------------------------------------------
+
+Reading and compressing of the daily temp/humid logs.
+
+Closed days (any day before today) are compressed into a "YYYYMMDD.txt.gz" file, in blocks of LOG_BLOCK_LINES lines.
+Each block is its own gzip member, so the file is still a normal gzip file (zcat, gzip.open, etc. all work), but a
+block can also be read on its own. A "YYYYMMDD.txt.gz.idx" file next to it holds the first timestamp, byte offset and
+last timestamp of each block, so a time range can be read without decompressing the whole day.
+
+The lines in a .txt.gz are always sorted by time. Readings from the spool can be flushed into a day after it was
+compressed, so those are merged in and the whole day is written again.
+
+A day's log can also start with a few lines from the day after, written just after midnight before the log file is
+switched over, so iter_records also looks at the day before the start.
+
+Everything that reads the logs should go through this module (iter_records, iter_day_records, iter_day_lines or
+open_log), so it does not matter whether a day is compressed or not. If a day has both a .txt.gz and a .txt (readings
+from the spool that were flushed after the day was compressed), both are read, .txt.gz first.
+
+Log line formats:
+    - Current:  "<timestamp>, <humid 1>, <temp 1>, <humid 2>, <temp 2>, <fan status>, <heat lamp status>"
+    - Original: "<timestamp>, <humid 1>, <temp 1>, <humid 2>, <temp 2>"
+    - Gap:      "<timestamp>, gap, <number of readings dropped>" (written by spool.py)
+
+"""
+import bisect
+import gzip
+import io
+import json
+import os
+import threading
+import time
+import crab_library
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+
+"""
+Number of lines in each compressed block, at one reading every 2 seconds this is about an hour
+"""
+LOG_BLOCK_LINES = 1800
+
+"""
+Seconds to wait between compressing each block, so the background compression never hogs the CPU or USB drive
+"""
+COMPRESSION_BLOCK_PAUSE_SECONDS = 0.05
+
+"""
+A single line from the logs. Values that were "err" or not in the line's format are None. For gap lines, gap is the
+number of readings dropped and everything other than the timestamp is None.
+"""
+LogRecord = namedtuple('LogRecord', ['timestamp', 'humidity_1', 'temperature_1', 'humidity_2', 'temperature_2',
+                                     'fan_status', 'heat_lamp_status', 'gap'])
+
+_compression_thread = None
+
+"""
+Held while adding lines to a day's log other than through the live log file (spool.py flushing readings after an
+outage), and by compress_log while it checks what it has read against the log, so lines added during compression are
+never lost
+"""
+append_lock = threading.Lock()
+
+
+def parse_timestamp(value):
+    """
+    :param value: Log timestamp in "%Y-%m-%d-%H:%M:%S" format
+    :return: The timestamp as a datetime (done by hand, strptime is several times slower)
+    """
+    return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                    int(value[11:13]), int(value[14:16]), int(value[17:19]))
+
+
+def format_line(timestamp, humidity_1, temperature_1, humidity_2, temperature_2, fan_status, heat_lamp_status):
+    """
+    Formats one reading as a line for the daily logs, in the current format
+
+    :param timestamp: datetime of the reading
+    :return: The log line, including the newline at the end
+    """
+    return (str(timestamp.strftime('%Y-%m-%d-%H:%M:%S'))
+            + ", " + str(humidity_1)
+            + ", " + str(temperature_1)
+            + ", " + str(humidity_2)
+            + ", " + str(temperature_2)
+            + ", " + fan_status
+            + ", " + heat_lamp_status
+            + '\n')
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def parse_line(line):
+    """
+    Parses one line from the logs, in any of the formats
+
+    :param line: The line from the log file
+    :return: The LogRecord, or None if the line could not be parsed (half written line from a power loss, etc.)
+    """
+    fields = line.rstrip("\n").split(", ")
+    try:
+        timestamp = parse_timestamp(fields[0])
+        if len(fields) == 3 and fields[1] == "gap":
+            return LogRecord(timestamp, None, None, None, None, None, None, int(fields[2]))
+        if len(fields) == 5:
+            fields = fields + [None, None]
+        elif len(fields) != 7:
+            return None
+    except (ValueError, IndexError):
+        return None
+
+    return LogRecord(timestamp, _to_float(fields[1]), _to_float(fields[2]), _to_float(fields[3]),
+                     _to_float(fields[4]), fields[5], fields[6], None)
+
+
+def log_days(directory=crab_library.TEMP_HUMID_PARENT_LOCATION):
+    """
+    :param directory: The directory with the daily logs
+    :return: Sorted list of every day ("YYYYMMDD") that has a log, compressed or not
+    """
+    days = set()
+    for path in directory.iterdir():
+        if path.name.endswith(".txt") or path.name.endswith(".txt.gz"):
+            days.add(path.name[:8])
+    return sorted(days)
+
+
+def day_log_paths(day, directory=crab_library.TEMP_HUMID_PARENT_LOCATION):
+    """
+    :param day: The day in "YYYYMMDD" format
+    :param directory: The directory with the daily logs
+    :return: The log files for that day that exist, in the order they should be read
+    """
+    paths = [directory / (day + ".txt.gz"), directory / (day + ".txt")]
+    return [path for path in paths if path.exists()]
+
+
+def open_log(path, binary=False):
+    """
+    Opens a log file for reading, whether it is compressed or not
+
+    :param path: Path to a .txt or .txt.gz log
+    :param binary: True to read bytes instead of text
+    :return: file object
+    """
+    if path.name.endswith(".gz"):
+        return gzip.open(path, "rb" if binary else "rt")
+    return open(path, "rb" if binary else "r")
+
+
+def _read_index(path):
+    try:
+        with open(str(path) + ".idx") as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError):
+        return []
+
+
+def _seek_plain_text(log_file, start):
+    """
+    Binary searches a plain text log for the first line at or after start, and leaves log_file positioned on the line
+    before it, so no lines at or after start are missed.
+    """
+    start_text = start.strftime('%Y-%m-%d-%H:%M:%S')
+    log_file.seek(0, os.SEEK_END)
+    low, high = 0, log_file.tell()
+    while high - low > 4096:
+        middle = (low + high) // 2
+        log_file.seek(middle)
+        log_file.readline()
+        line = log_file.readline()
+        if line and line[:19].decode(errors="replace") < start_text:
+            low = middle
+        else:
+            high = middle
+    log_file.seek(low)
+    if low:
+        log_file.readline()
+
+
+def _iter_lines(path, start):
+    """
+    Yields the lines of a log file, skipping ahead to near start if given (using the block index for .txt.gz files and
+    a binary search for .txt files). Lines from just before start can still be yielded.
+    """
+    with open(path, "rb") as raw_file:
+        if path.name.endswith(".gz"):
+            index = _read_index(path)
+            if start is not None and index:
+                start_text = start.strftime('%Y-%m-%d-%H:%M:%S')
+                # Everything in the file is before start (i.e. the day before, checked for lines from after midnight)
+                if index[-1][2] < start_text:
+                    return
+                # The block before the first one starting at or after start, as it can end with lines at start
+                block = bisect.bisect_left([entry[0] for entry in index], start_text) - 1
+                if block > 0:
+                    raw_file.seek(index[block][1])
+            with gzip.GzipFile(fileobj=raw_file) as log_file:
+                for line in log_file:
+                    yield line.decode(errors="replace")
+        else:
+            if start is not None:
+                _seek_plain_text(raw_file, start)
+            for line in raw_file:
+                yield line.decode(errors="replace")
+
+
+def iter_file_records(path, start=None, end=None):
+    """
+    Yields the LogRecords from one log file, compressed or not, in order
+
+    :param path: The log file
+    :param start: If given, only records at or after this datetime
+    :param end: If given, only records before this datetime
+    """
+    for line in _iter_lines(path, start):
+        record = parse_line(line)
+        if record is None:
+            continue
+        if start is not None and record.timestamp < start:
+            continue
+        if end is not None and record.timestamp >= end:
+            return
+        yield record
+
+
+def iter_day_records(day, directory=crab_library.TEMP_HUMID_PARENT_LOCATION, start=None, end=None):
+    """
+    Yields the LogRecords from one day's logs, compressed or not, in order
+
+    :param day: The day in "YYYYMMDD" format
+    :param directory: The directory with the daily logs
+    :param start: If given, only records at or after this datetime
+    :param end: If given, only records before this datetime
+    """
+    for path in day_log_paths(day, directory):
+        yield from iter_file_records(path, start, end)
+
+
+def iter_day_lines(day, directory=crab_library.TEMP_HUMID_PARENT_LOCATION, start=None):
+    """
+    Yields the lines of one day's logs as they are written in the files, compressed or not, in order. The last line can
+    be missing its newline if it is still being written.
+
+    :param day: The day in "YYYYMMDD" format
+    :param directory: The directory with the daily logs
+    :param start: If given, only lines with a timestamp at or after this datetime
+    """
+    start_text = start.strftime('%Y-%m-%d-%H:%M:%S') if start is not None else None
+    for path in day_log_paths(day, directory):
+        for line in _iter_lines(path, start):
+            if start_text is None or line[:19] >= start_text:
+                yield line
+
+
+def iter_records(directory=crab_library.TEMP_HUMID_PARENT_LOCATION, start=None, end=None):
+    """
+    Yields the LogRecords from all of the logs in the directory in order, only opening the days that overlap with the
+    start/end range
+
+    :param directory: The directory with the daily logs
+    :param start: If given, only records at or after this datetime
+    :param end: If given, only records before this datetime
+    """
+    # The day before the start can have lines from just after midnight at the end
+    first_day = (start - timedelta(days=1)).strftime('%Y%m%d') if start is not None else None
+    for day in log_days(directory):
+        if first_day is not None and day < first_day:
+            continue
+        if end is not None and day > end.strftime('%Y%m%d'):
+            break
+        yield from iter_day_records(day, directory, start, end)
+
+
+def compress_log(path):
+    """
+    Compresses a plain text daily log into blocks and removes the original. If the day is already compressed, the lines
+    are merged with the ones already in the .txt.gz, and the whole day is written again in time order. Lines that are
+    exactly the same (a .txt that was compressed before, but not removed because of a power loss) are only kept once.
+
+    The compressed file is written to a .tmp file first and then renamed over the old one, so a power loss at any point
+    leaves either the old files or the new ones, never a half written log.
+
+    Only the part of the log that was there when compression started is compressed. Any lines added while compressing
+    are left in the .txt, to be compressed next time.
+
+    :param path: Path to the .txt log
+    """
+    gz_path = path.with_name(path.name + ".gz")
+    temp_path = path.with_name(path.name + ".gz.tmp")
+
+    # Lines are only ever added whole while holding the lock, so this is the end of a line
+    with append_lock:
+        size = path.stat().st_size
+
+    lines = []
+    if gz_path.exists():
+        with gzip.open(gz_path, "rb") as gz_file:
+            lines.extend(gz_file)
+    with open(path, "rb") as log_file:
+        lines.extend(io.BytesIO(log_file.read(size)))
+
+    # A half written line (power loss) gets ended here, so it isn't joined onto the line after it once sorted
+    lines = [line if line.endswith(b"\n") else line + b"\n" for line in lines]
+    # Sorted by the timestamp at the front, sorted() keeps lines with the same timestamp in the order they were
+    lines.sort(key=lambda line: line[:19])
+    lines = [line for i, line in enumerate(lines) if i == 0 or line != lines[i - 1]]
+
+    index = []
+    with open(temp_path, "wb") as out_file:
+        for i in range(0, len(lines), LOG_BLOCK_LINES):
+            block = lines[i:i + LOG_BLOCK_LINES]
+            index.append([block[0][:19].decode(errors="replace"), out_file.tell(),
+                          block[-1][:19].decode(errors="replace")])
+            out_file.write(gzip.compress(b"".join(block), compresslevel=9))
+            time.sleep(COMPRESSION_BLOCK_PAUSE_SECONDS)
+
+        out_file.flush()
+        os.fsync(out_file.fileno())
+
+    with open(str(temp_path) + ".idx", "w") as index_file:
+        json.dump(index, index_file)
+
+    with append_lock:
+        # Anything added since compression started stays in the .txt
+        with open(path, "rb") as log_file:
+            log_file.seek(size)
+            added = log_file.read()
+        os.replace(str(temp_path) + ".idx", str(gz_path) + ".idx")
+        os.replace(temp_path, gz_path)
+        if added:
+            added_path = path.with_name(path.name + ".tmp")
+            with open(added_path, "wb") as added_file:
+                added_file.write(added)
+            os.replace(added_path, path)
+        else:
+            os.remove(path)
+
+
+def compress_closed_logs(directory=crab_library.TEMP_HUMID_PARENT_LOCATION, skip_days=()):
+    """
+    Compresses every plain text log from before today
+
+    :param directory: The directory with the daily logs
+    :param skip_days: Days ("YYYYMMDD") not to compress yet, i.e. days the spool still has readings for
+    :return: The number of logs compressed
+    """
+    today = datetime.today().strftime('%Y%m%d')
+    compressed = 0
+    for path in sorted(directory.glob("*.txt")):
+        if path.name[:8] < today and path.name[:8] not in skip_days:
+            before = path.stat().st_size
+            compress_log(path)
+            after = (path.with_name(path.name + ".gz")).stat().st_size
+            crab_library.print_log(f"COMPRESSION: Compressed {path.name} {before} -> {after} bytes", 2)
+            compressed = compressed + 1
+    return compressed
+
+
+def start_background_compression(directory=crab_library.TEMP_HUMID_PARENT_LOCATION, skip_days=()):
+    """
+    Starts compress_closed_logs in a background thread, unless one is already running
+
+    :param directory: The directory with the daily logs
+    :param skip_days: Days ("YYYYMMDD") not to compress yet, i.e. days the spool still has readings for
+    """
+    global _compression_thread
+    if _compression_thread is not None and _compression_thread.is_alive():
+        return
+
+    def run():
+        try:
+            compress_closed_logs(directory, skip_days)
+        except Exception as e:
+            crab_library.print_log(f"COMPRESSION-ERROR: Issue while compressing closed logs: {e}", 0)
+
+    _compression_thread = threading.Thread(target=run, daemon=True)
+    _compression_thread.start()
@@ -0,0 +1,291 @@
+"""
+Joel Yuhas
+Raspberry-Pi/Hermit Crab project
+
+-------------------------------------------------------------------------------------
+spool.py
+-------------------------------------------------------------------------------------
+
+Holds on to temp/humid readings and pictures while the USB drive is unavailable (unmounted, being swapped, etc.), and
+moves them onto the drive once it is back.
+
+Everything is kept in SPOOL_DIRECTORY, which is on tmpfs (RAM), so the spool survives a program crashing or being
+restarted, while never writing to the SD card.
+
+Both spools have a max size. Once full, the oldest entry is dropped and counted, and once the drive is back a gap
+marker is written, so it is clear later on that data is missing rather than the data just not being there:
+    - Temp/Humid: a "<timestamp>, gap, <count>" line in the daily log, at the time of the first dropped reading
+    - Camera: a "<picture name>, gap, <count>" line in a gaps.txt file in the hour folder (or a "<hour>_gaps.txt" file
+              next to the container, with container files)
+
+Moving the data back onto the drive is done a few entries at a time (SPOOL_FLUSH_*_PER_TICK), so that a large backlog
+never holds up the live capture.
+
+"""
+import os
+import crab_library
+import log_store
+
+from collections import deque
+from datetime import datetime
+
+
+def log_file_for(line):
+    """
+    :param line: A temp/humid log line, which starts with a "%Y-%m-%d-%H:%M:%S" timestamp
+    :return: The daily log file the line belongs in
+    """
+    return crab_library.TEMP_HUMID_PARENT_LOCATION / (line[0:4] + line[5:7] + line[8:10] + '.txt')
+
+
+class SampleSpool:
+    """
+    Ring buffer of temp/humid log lines.
+
+    Every line added is also appended to samples.txt in the spool directory, and each flush appends a
+    "flushed, <count>" line, meaning the oldest count lines (and the gap marker) made it onto the drive. On a restart the
+    file is read back doing the same adds and flushes, so the spool ends up exactly as it was. The file is only
+    rewritten once it holds more than twice max_samples lines, and emptied once everything is flushed.
+    """
+    def __init__(self, directory=crab_library.SPOOL_DIRECTORY, max_samples=crab_library.SPOOL_MAX_SAMPLES):
+        self.path = directory / 'samples.txt'
+        self.max_samples = max_samples
+        self.samples = deque()
+        # [timestamp of first dropped line, number dropped], or None if nothing dropped
+        self.gap = None
+        self.lines_in_file = 0
+
+        directory.mkdir(parents=True, exist_ok=True)
+        if self.path.exists():
+            with open(self.path) as spool_file:
+                for line in spool_file:
+                    # A gap header is only ever written as the first line
+                    if self.gap is None and not self.samples and line.split(", ")[1:2] == ["gap"]:
+                        timestamp, _, count = line.rstrip("\n").split(", ")
+                        self.gap = [timestamp, int(count)]
+                    elif line.startswith("flushed, "):
+                        self._remove_flushed(int(line.rstrip("\n").split(", ")[1]))
+                    else:
+                        self._append(line)
+                    self.lines_in_file = self.lines_in_file + 1
+            if self.samples:
+                crab_library.print_log(f"SPOOL: Recovered {len(self.samples)} readings from {self.path}", 1)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def has_pending(self):
+        """
+        :return: True if there are readings or a gap marker still to be written to the drive
+        """
+        return bool(self.samples) or self.gap is not None
+
+    def days(self):
+        """
+        :return: The days ("YYYYMMDD") the spool still has readings (or a gap marker) for, these logs shouldn't be
+                 compressed yet
+        """
+        days = {log_file_for(line).name[:8] for line in self.samples}
+        if self.gap is not None:
+            days.add(log_file_for(self.gap[0]).name[:8])
+        return days
+
+    def _append(self, line):
+        self.samples.append(line)
+        if len(self.samples) > self.max_samples:
+            dropped = self.samples.popleft()
+            if self.gap is None:
+                self.gap = [dropped.split(", ")[0], 0]
+            self.gap[1] = self.gap[1] + 1
+
+    def _remove_flushed(self, count):
+        # The gap marker is always written with the first line of a flush
+        self.gap = None
+        for _ in range(min(count, len(self.samples))):
+            self.samples.popleft()
+
+    def add(self, line):
+        """
+        Adds a log line to the spool
+
+        :param line: The full log line, including the newline at the end
+        """
+        self._append(line)
+        with open(self.path, "a") as spool_file:
+            spool_file.write(line)
+        self.lines_in_file = self.lines_in_file + 1
+
+        # Keep the file from growing forever while the drive is gone
+        if self.lines_in_file > 2 * self.max_samples:
+            self._rewrite()
+
+    def flush(self, limit=crab_library.SPOOL_FLUSH_SAMPLES_PER_TICK):
+        """
+        Writes up to limit of the oldest lines (and the gap marker, if any) to their daily log files. Lines are only
+        removed from the spool once they have been written.
+
+        :param limit: The most lines to write
+        :return: The number of lines written
+        """
+        if not self.samples and self.gap is None:
+            return 0
+
+        batch = []
+        if self.gap is not None:
+            batch.append(f"{self.gap[0]}, gap, {self.gap[1]}\n")
+        batch.extend(self.samples[i] for i in range(min(limit, len(self.samples))))
+
+        # Group by day so each daily log is only opened once. Held under the lock so the background compression never
+        # removes a log while lines are being added to it (see log_store.py)
+        open_path = None
+        log_file = None
+        with log_store.append_lock:
+            try:
+                for line in batch:
+                    path = log_file_for(line)
+                    if path != open_path:
+                        if log_file is not None:
+                            log_file.close()
+                        log_file = open(path, "a")
+                        open_path = path
+                    log_file.write(line)
+            finally:
+                if log_file is not None:
+                    log_file.close()
+
+        written = len(batch)
+        if self.gap is not None:
+            crab_library.print_log(f"SPOOL: {self.gap[1]} readings were dropped starting at {self.gap[0]}", 1)
+            written = written - 1
+        self._remove_flushed(written)
+
+        # Only record the flush once the lines are on the drive, so a crash before this writes them again rather than
+        # losing them
+        if not self.samples:
+            open(self.path, "w").close()
+            self.lines_in_file = 0
+        else:
+            with open(self.path, "a") as spool_file:
+                spool_file.write(f"flushed, {written}\n")
+            self.lines_in_file = self.lines_in_file + 1
+            if self.lines_in_file > 2 * self.max_samples:
+                self._rewrite()
+        crab_library.print_log(f"SPOOL: Flushed {written} readings, {len(self.samples)} left", 2)
+        return written
+
+    def _rewrite(self):
+        temp_path = self.path.with_suffix('.tmp')
+        with open(temp_path, "w") as spool_file:
+            if self.gap is not None:
+                spool_file.write(f"{self.gap[0]}, gap, {self.gap[1]}\n")
+            spool_file.writelines(self.samples)
+        os.replace(temp_path, self.path)
+        self.lines_in_file = len(self.samples)
+
+
+class FrameSpool:
+    """
+    Capped queue of pictures.
+
+    Each picture is a file in the frames directory of the spool, named "<hour folder>_<picture name>", so they sort in
+    the order they were taken. Dropped counts per hour folder are kept in frame_gaps.txt.
+    """
+    def __init__(self, directory=crab_library.SPOOL_DIRECTORY, max_frames=crab_library.SPOOL_MAX_FRAMES):
+        self.frame_directory = directory / 'frames'
+        self.gap_path = directory / 'frame_gaps.txt'
+        self.max_frames = max_frames
+        # hour folder -> [first dropped picture name, number dropped]
+        self.gaps = {}
+
+        self.frame_directory.mkdir(parents=True, exist_ok=True)
+        self.frames = deque(sorted(path.name for path in self.frame_directory.iterdir()))
+        if self.gap_path.exists():
+            with open(self.gap_path) as gap_file:
+                for line in gap_file:
+                    hour, picture_name, count = line.rstrip("\n").split(", ")
+                    self.gaps[hour] = [picture_name, int(count)]
+        if self.frames:
+            crab_library.print_log(f"SPOOL: Recovered {len(self.frames)} pictures from {self.frame_directory}", 1)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def add(self, hour, picture_name, data):
+        """
+        Adds a picture to the spool, dropping the oldest picture if full
+
+        :param hour: The hour folder name the picture belongs in (%Y%m%d%H)
+        :param picture_name: The picture's file name
+        :param data: The picture's bytes
+        """
+        name = f"{hour}_{picture_name}"
+        with open(self.frame_directory / name, "wb") as frame_file:
+            frame_file.write(data)
+        self.frames.append(name)
+
+        if len(self.frames) > self.max_frames:
+            dropped = self.frames.popleft()
+            os.remove(self.frame_directory / dropped)
+            self._add_gap(dropped)
+
+    def _add_gap(self, name):
+        hour, picture_name = name.split("_", 1)
+        gap = self.gaps.setdefault(hour, [picture_name, 0])
+        gap[1] = gap[1] + 1
+        self._write_gaps()
+
+    def flush(self, limit=crab_library.SPOOL_FLUSH_FRAMES_PER_TICK, containers=None):
+        """
+        Moves up to limit of the oldest pictures (and any gap markers) into their hour folders on the USB drive
+
+        :param limit: The most pictures to move
+        :param containers: HourlyContainers to add the pictures to, if using container files (see capture_container.py)
+        :return: The number of pictures moved
+        """
+        for hour, (picture_name, count) in list(self.gaps.items()):
+            if containers is not None:
+                gap_path = crab_library.CAMERA_PARENT_LOCATION / (hour + '_gaps.txt')
+            else:
+                hour_directory = crab_library.CAMERA_PARENT_LOCATION / hour
+                hour_directory.mkdir(exist_ok=True)
+                gap_path = hour_directory / 'gaps.txt'
+            with open(gap_path, "a") as gap_file:
+                gap_file.write(f"{picture_name}, gap, {count}\n")
+            crab_library.print_log(f"SPOOL: {count} pictures were dropped from {hour} starting at {picture_name}", 1)
+            del self.gaps[hour]
+            self._write_gaps()
+
+        moved = 0
+        while self.frames and moved < limit:
+            name = self.frames[0]
+            hour, picture_name = name.split("_", 1)
+            hour_directory = crab_library.CAMERA_PARENT_LOCATION / hour
+            try:
+                with open(self.frame_directory / name, "rb") as frame_file:
+                    data = frame_file.read()
+            except FileNotFoundError:
+                # Removed from the spool by hand, or lost. Counted as dropped, rather than stopping the flush (which
+                # would look like the USB drive is gone)
+                crab_library.print_log(f"SPOOL: Spooled picture {name} is missing, counting it as dropped", 0)
+                self.frames.popleft()
+                self._add_gap(name)
+                continue
+            if containers is not None:
+                containers.add(hour_directory, picture_name, data,
+                               datetime.strptime(hour + picture_name[6:10], '%Y%m%d%H%M%S'))
+            else:
+                hour_directory.mkdir(exist_ok=True)
+                with open(hour_directory / picture_name, "wb") as picture_file:
+                    picture_file.write(data)
+            os.remove(self.frame_directory / name)
+            self.frames.popleft()
+            moved = moved + 1
+
+        if moved:
+            crab_library.print_log(f"SPOOL: Flushed {moved} pictures, {len(self.frames)} left", 2)
+        return moved
+
+    def _write_gaps(self):
+        with open(self.gap_path, "w") as gap_file:
+            for hour, (picture_name, count) in self.gaps.items():
+                gap_file.write(f"{hour}, {picture_name}, {count}\n")
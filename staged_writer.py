@@ -0,0 +1,171 @@
+"""
+Joel Yuhas
+Raspberry-Pi/Hermit Crab project
+
+-------------------------------------------------------------------------------------
+staged_writer.py
+-------------------------------------------------------------------------------------
+
+Writes pictures to the USB drive from a separate thread, so the time it takes to write to the USB drive (which can
+jump around a lot) is not part of the time between pictures.
+
+camera_capture.py captures each picture into memory and hands it to put(). The writer thread waits until
+CAMERA_STAGED_BATCH_FRAMES pictures are waiting (or the oldest has waited CAMERA_STAGED_BATCH_SECONDS), then writes them
+all one after another, which is easier on the flash than a small write every couple seconds.
+
+The queue holds at most CAMERA_STAGED_QUEUE_FRAMES pictures. If it is full (USB drive too slow), put() waits
+CAMERA_STAGED_PUT_TIMEOUT_SECONDS for room and otherwise hands the picture back, so it can go in the spool instead.
+Pictures that fail to write (USB drive removed) are also handed back, through take_failed().
+
+With container files (see capture_container.py), the pictures are added to the hour's container instead, flushed
+after each batch.
+
+metrics() has the queue depth, wait and write times, etc., so it can be seen how close the USB drive is to keeping up.
+
+"""
+import queue
+import threading
+import time
+import crab_library
+
+
+class StagedWriter:
+    def __init__(self, max_queue_frames=crab_library.CAMERA_STAGED_QUEUE_FRAMES,
+                 batch_frames=crab_library.CAMERA_STAGED_BATCH_FRAMES,
+                 batch_seconds=crab_library.CAMERA_STAGED_BATCH_SECONDS,
+                 put_timeout_seconds=crab_library.CAMERA_STAGED_PUT_TIMEOUT_SECONDS, containers=None):
+        """
+        :param containers: HourlyContainers to add the pictures to, None to write each picture to its own file
+        """
+        self.queue = queue.Queue(maxsize=max_queue_frames)
+        self.batch_frames = batch_frames
+        self.batch_seconds = batch_seconds
+        self.put_timeout_seconds = put_timeout_seconds
+        self.containers = containers
+
+        # Pictures that could not be written, as (directory, name, data, taken), for the capture loop to spool
+        self.failed = []
+        self.lock = threading.Lock()
+        self.stats = {
+            "queued": 0,
+            "written": 0,
+            "failed": 0,
+            "rejected": 0,
+            "batches": 0,
+            "max_depth": 0,
+            "put_wait_seconds_total": 0.0,
+            "put_wait_seconds_max": 0.0,
+            "batch_write_seconds_last": 0.0,
+            "batch_write_seconds_max": 0.0,
+        }
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, directory, name, data, taken):
+        """
+        Queues a picture to be written
+
+        :param directory: The directory to write the picture to
+        :param name: The picture's file name
+        :param data: The picture's bytes
+        :param taken: datetime the picture was taken
+        :return: True if queued, False if the queue stayed full (the picture was not queued)
+        """
+        start = time.monotonic()
+        try:
+            self.queue.put((directory, name, data, taken), timeout=self.put_timeout_seconds)
+            queued = True
+        except queue.Full:
+            queued = False
+        waited = time.monotonic() - start
+
+        with self.lock:
+            self.stats["put_wait_seconds_total"] = self.stats["put_wait_seconds_total"] + waited
+            self.stats["put_wait_seconds_max"] = max(self.stats["put_wait_seconds_max"], waited)
+            if queued:
+                self.stats["queued"] = self.stats["queued"] + 1
+                self.stats["max_depth"] = max(self.stats["max_depth"], self.queue.qsize())
+            else:
+                self.stats["rejected"] = self.stats["rejected"] + 1
+        return queued
+
+    def take_failed(self):
+        """
+        :return: The pictures that failed to write since the last call, as (directory, name, data, taken)
+        """
+        with self.lock:
+            failed = self.failed
+            self.failed = []
+        return failed
+
+    def metrics(self):
+        """
+        :return: Copy of the stats, plus the current queue depth
+        """
+        with self.lock:
+            metrics = dict(self.stats)
+        metrics["depth"] = self.queue.qsize()
+        return metrics
+
+    def wait_until_empty(self):
+        """
+        Blocks until every queued picture has been written (or failed)
+        """
+        self.queue.join()
+
+    def _next_batch(self):
+        # Wait as long as it takes for the first picture, then up to batch_seconds for the rest of the batch
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.batch_seconds
+        while len(batch) < self.batch_frames:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                # Never let the thread die, put() and wait_until_empty() depend on it
+                crab_library.print_log(f"STAGED-WRITE-ERROR: Issue writing a batch of {len(batch)} pictures: {e}", 0)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _write_batch(self, batch):
+        start = time.monotonic()
+        written = 0
+        failed = []
+        for directory, name, data, taken in batch:
+            try:
+                if self.containers is not None:
+                    self.containers.add(directory, name, data, taken)
+                else:
+                    with open(directory / name, "wb") as picture_file:
+                        picture_file.write(data)
+                written = written + 1
+            except Exception as e:
+                crab_library.print_log(f"STAGED-WRITE-ERROR: Issue writing {directory / name}: {e}", 0)
+                failed.append((directory, name, data, taken))
+        if self.containers is not None:
+            try:
+                self.containers.flush()
+            except Exception as e:
+                crab_library.print_log(f"STAGED-WRITE-ERROR: Issue flushing the container: {e}", 0)
+        seconds = time.monotonic() - start
+
+        with self.lock:
+            self.failed.extend(failed)
+            self.stats["written"] = self.stats["written"] + written
+            self.stats["failed"] = self.stats["failed"] + len(failed)
+            self.stats["batches"] = self.stats["batches"] + 1
+            self.stats["batch_write_seconds_last"] = seconds
+            self.stats["batch_write_seconds_max"] = max(self.stats["batch_write_seconds_max"], seconds)
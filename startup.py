@@ -0,0 +1,218 @@
+"""
+Joel Yuhas
+Raspberry-Pi/Hermit Crab project
+
+-------------------------------------------------------------------------------------
+startup.py
+-------------------------------------------------------------------------------------
+
+Starts all the programs on boot, replacing the fixed "sleep 60" that was in startup.sh.
+
+Rather than waiting a set amount of time and hoping everything is up, each program has a list of things it needs
+(USB drive, camera, GPIO). Each of these is checked in a loop, waiting a little longer between each check, and the
+program is started as soon as everything it needs is ready. This way the temp/humid program does not have to wait on
+the camera and vice versa.
+
+Nothing heavy (cv2, picamera, adafruit_dht) is imported here, those are only loaded by the programs themselves once
+they are started.
+
+The network work (git pull) is done in the background after the programs are started, so no network does not delay
+the sampling.
+
+"""
+import os
+import subprocess
+import sys
+import threading
+import time
+import crab_library
+
+from pathlib import Path
+
+
+PROJECT_DIRECTORY = Path(__file__).resolve().parent
+LOG_DIRECTORY = PROJECT_DIRECTORY / 'logs'
+GIT_PULL_TIMEOUT_SECONDS = 60
+
+
+def camera_ready():
+    """
+    :return: True if any of the camera devices are present
+    """
+    return any(device.exists() for device in crab_library.CAMERA_DEVICE_PATHS)
+
+
+def gpio_ready():
+    """
+    :return: True if the GPIO device is present and can be opened
+    """
+    return os.access(crab_library.GPIO_DEVICE_PATH, os.R_OK | os.W_OK)
+
+
+"""
+Each requirement, and the function used to check if it is ready
+"""
+REQUIREMENTS = {
+    "usb": crab_library.usb_ready,
+    "camera": camera_ready,
+    "gpio": gpio_ready,
+}
+
+"""
+Each program that gets started, what it needs before starting, and any commands that need to run right before it.
+
+The camera program needs the "motion" program killed first, as motion holds onto the camera.
+
+temp_humid_capture doesn't wait for the USB drive, it holds its readings in the spool (see spool.py) until the drive is
+ready, so no readings are lost while waiting.
+"""
+PROGRAMS = [
+    {
+        "name": "temp_humid_capture",
+        "command": ["python3", "temp_humid_capture.py"],
+        "requires": ["gpio"],
+        "before": [],
+    },
+    {
+        "name": "camera_capture",
+        "command": ["python3", "camera_capture.py"],
+        "requires": ["usb", "camera"],
+        "before": [["sudo", "killall", "motion"]],
+    },
+    {
+        "name": "capture_index",
+        "command": ["python3", "capture_index.py", "--watch"],
+        "requires": ["usb"],
+        "before": [],
+    },
+    {
+        "name": "dashboard",
+        "command": ["python3", "dashboard.py", "--watch"],
+        "requires": ["usb"],
+        "before": [],
+    },
+    {
+        "name": "log_shipper",
+        "command": ["python3", "log_shipper.py", "--watch"],
+        "requires": ["usb"],
+        "before": [],
+    },
+]
+
+
+def wait_for(name, check, timeout=crab_library.STARTUP_TIMEOUT_SECONDS):
+    """
+    Calls the check function until it returns True or until the timeout runs out. The wait between each check starts at
+    STARTUP_POLL_INITIAL_SECONDS and is doubled each time up to STARTUP_POLL_MAX_SECONDS, so things that are ready fast
+    are found fast, without spinning on things that take a while.
+
+    :param name: Name of what is being waited on (for the logs)
+    :param check: function that returns True once ready
+    :param timeout: How long in seconds to wait before giving up
+    :return: True if ready, False if the timeout ran out
+    """
+    start = time.monotonic()
+    delay = crab_library.STARTUP_POLL_INITIAL_SECONDS
+    while True:
+        try:
+            if check():
+                crab_library.print_log(f"STARTUP: {name} ready after {time.monotonic() - start:.1f}s", 1)
+                return True
+        except Exception as e:
+            crab_library.print_log(f"STARTUP-ERROR: Issue while checking {name}: {e}", 0)
+
+        remaining = timeout - (time.monotonic() - start)
+        if remaining <= 0:
+            crab_library.print_log(f"STARTUP-ERROR: {name} not ready after {timeout}s", 0)
+            return False
+
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, crab_library.STARTUP_POLL_MAX_SECONDS)
+
+
+class Requirement:
+    """
+    Wraps one requirement so that it is only waited on once, even when multiple programs need it. The first program
+    to ask does the waiting, the others wait on the result.
+    """
+    def __init__(self, name, check):
+        self.name = name
+        self.check = check
+        self.lock = threading.Lock()
+        self.result = None
+
+    def wait(self):
+        with self.lock:
+            if self.result is None:
+                self.result = wait_for(self.name, self.check)
+            return self.result
+
+
+def start_program(program, requirements):
+    """
+    Waits for all the requirements of a program, then starts it with its output going to logs/output_<name>.txt
+
+    If a requirement times out, the program is still started, as the programs keep retrying initialize() on their own.
+    It's better to have the fan control running without the USB drive than not at all.
+
+    :param program: one of the PROGRAMS entries
+    :param requirements: dictionary of Requirement objects
+    :return: the started process
+    """
+    for requirement in program["requires"]:
+        if not requirements[requirement].wait():
+            crab_library.print_log(f"STARTUP-ERROR: Starting {program['name']} without {requirement}", 0)
+
+    for command in program["before"]:
+        subprocess.run(command, cwd=PROJECT_DIRECTORY, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    log_file = open(LOG_DIRECTORY / f"output_{program['name']}.txt", "a")
+    process = subprocess.Popen(program["command"], cwd=PROJECT_DIRECTORY, stdout=log_file, stderr=subprocess.STDOUT)
+    crab_library.print_log(f"STARTUP: Started {program['name']} (pid {process.pid})", 1)
+    return process
+
+
+def git_pull():
+    """
+    Pulls any code updates. Done after the programs are started with a timeout, so with no network the pull can't hold
+    anything up. Any updates are picked up on the next boot.
+    """
+    try:
+        result = subprocess.run(["git", "pull"], cwd=PROJECT_DIRECTORY, timeout=GIT_PULL_TIMEOUT_SECONDS,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except subprocess.TimeoutExpired:
+        crab_library.print_log("STARTUP-ERROR: git pull timed out", 0)
+        return
+    except OSError as e:
+        crab_library.print_log(f"STARTUP-ERROR: Issue running git pull: {e}", 0)
+        return
+    # i.e. local changes in the way of the update, which would otherwise go unnoticed
+    if result.returncode != 0:
+        crab_library.print_log(f"STARTUP-ERROR: git pull failed ({result.returncode}): "
+                               f"{result.stderr.decode(errors='replace').strip()}", 0)
+
+
+def main():
+    LOG_DIRECTORY.mkdir(exist_ok=True)
+    requirements = {name: Requirement(name, check) for name, check in REQUIREMENTS.items()}
+
+    # Start each program in its own thread so each one starts as soon as its own requirements are ready
+    processes = []
+    threads = []
+    for program in PROGRAMS:
+        thread = threading.Thread(target=lambda p=program: processes.append(start_program(p, requirements)))
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    git_pull()
+
+    # Stay alive as long as the programs are, so startup.sh's output logs cover the whole run
+    for process in processes:
+        process.wait()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -16,6 +16,9 @@ This loop will do the following:
     - If the humid is above HUMIDITY_UPPER_LIMIT turn on the fan
     - If the humid is below HUMIDITY_LOWER_LIMIT turn off the fan
     - If the directory becomes too full, delete LOG_DAYS_TO_CLEAR worth of folders
+    - Check the readings for sensor drift, stuck values and jumps, and flash the LEDs if found (see anomaly_detector.py)
+    - Compress the logs from previous days in the background (see log_store.py)
+    - If the USB drive is unavailable, hold the readings in the spool (see spool.py) until it is back
 
 Directory layout/methodology:
 - In the USB drive, all pictures are stored in the /temp-humid-captures/ directory, and all information is stored in
@@ -28,9 +31,12 @@ import time
 import adafruit_dht
 import board
 import crab_library
+import log_store
 import RPi.GPIO as GPIO
 
+from anomaly_detector import AnomalyDetector
 from Sensor import Sensor
+from spool import SampleSpool
 from datetime import datetime
 from time import sleep
 
@@ -171,6 +177,27 @@ def led_status_for_temp_and_humid_values(temp_average, humid_average):
         print(e)
 
 
+def sensor_alert(message):
+    """
+    Raised by the anomaly detector when a sensor looks like it is drifting, stuck or jumping. Prints the alert and
+    flashes both status LEDs together, which the normal LED status never does, so it stands out.
+
+    :param message: The alert message
+    """
+    crab_library.print_log(f"SENSOR-ALERT: {message}", 1)
+    try:
+        for i in range(3):
+            GPIO.output(27, 1)
+            GPIO.output(22, 1)
+            sleep(0.1)
+            GPIO.output(27, 0)
+            GPIO.output(22, 0)
+            sleep(0.1)
+    except Exception as e:
+        crab_library.print_log("LED-SET-ERROR: Issue flashing LEDs for sensor alert", 0)
+        print(e)
+
+
 # Initialize GPIO
 GPIO.setmode(GPIO.BCM)  # choose BCM or BOARD
 GPIO.setup(17, GPIO.OUT)  # Humidity control fan
@@ -191,11 +218,19 @@ sensor_2 = Sensor(dhtSensor2, 2)
 
 sensor_list = [sensor_1,sensor_2]
 
+# Watches the sensors for drift, stuck values and jumps
+anomaly_detector = AnomalyDetector(sensor_alert)
+
+# Holds on to readings while the USB drive is unavailable
+sample_spool = SampleSpool()
 
 check_counter = 10
 check_counter_toggle = False
 fan_status = "off"
 heat_lamp_status = "off"
+# Whether the averages were in the ideal range last loop, so a video clip is only asked for when they leave it. None
+# until the first averages, so starting up out of range doesn't ask for a clip
+in_ideal_range = None
 
 # Print out of initialization
 crab_library.print_log(f"Log Severity meter set to: {crab_library.DEBUG_LOG_TOGGLE_THRESHOLD}", 0)
@@ -207,8 +242,13 @@ crab_library.print_log(f"LOG_DAYS_TO_CLEAR: {crab_library.TEMP_HUMID_LOG_DAYS_TO
 crab_library.print_log("----------------------------", 1)
 
 
-# First initialization
-log_file = crab_library.initialize(check_counter_toggle, crab_library.TEMP_HUMID_TYPE_FLAG)
+# First initialization, if the USB drive is not ready yet the main loop keeps retrying
+log_file = None
+try:
+    log_file = crab_library.initialize(check_counter_toggle, crab_library.TEMP_HUMID_TYPE_FLAG)
+except Exception as e:
+    crab_library.print_log("INITIALIZATION-ERROR: Issue during the first initialize for temp-humid", 0)
+    print(e)
 
 # Main loop
 while True:
@@ -222,30 +262,70 @@ while True:
         try:
             log_file = crab_library.initialize(check_counter_toggle, crab_library.TEMP_HUMID_TYPE_FLAG)
             check_counter_toggle = False
+
+            # Compress any logs from previous days, in the background so it never holds up the readings. Days the spool
+            # still has readings for are left until it has caught up
+            log_store.start_background_compression(skip_days=sample_spool.days())
+
+            for sensor in sensor_list:
+                crab_library.print_log(sensor.health_summary(), 2)
         except Exception as e:
+            # Keep reading and controlling the fan, the readings are held in the spool until the drive is back
             crab_library.print_log("INITIALIZATION-ERROR: Issue while attempting to initialize for temp-humid", 0)
-            continue
+            log_file = None
+
+    # Move a few spooled readings back onto the drive each loop until caught up
+    if log_file is not None and sample_spool.has_pending():
+        try:
+            sample_spool.flush()
+        except Exception as e:
+            crab_library.print_log("SPOOL-ERROR: Issue flushing spooled readings to the log files", 0)
+            print(e)
+            log_file = None
 
     avg_humid = 0
     avg_temp = 0
     avg_counter = 0
 
-    # Temp and Humidity Capture, if signal is valid, add to final average
+    # Temp and Humidity Capture, if a new reading was made, add to final average. Sensors that are failing are only
+    # read once their backoff is up (see Sensor.py)
     for sensor in sensor_list:
         sensor.get_temp_and_humid()
-        if sensor.status == "ONLINE":
+        if sensor.fresh:
             avg_humid = avg_humid + sensor.humidity
             avg_temp = avg_temp + sensor.tempeture_f
             avg_counter = avg_counter + 1
 
+    # Check the sensors for drift, stuck values and jumps
+    try:
+        anomaly_detector.update(sensor_list)
+    except Exception as e:
+        crab_library.print_log("ANOMALY-ERROR: Issue checking sensors for anomalies", 0)
+        print(e)
+
     # Calculate averages
     if avg_counter != 0:
         avg_humid = avg_humid/avg_counter
         avg_temp = avg_temp/avg_counter
 
         # Fan Control
+        previous_fan_status = fan_status
         fan_status = fan_control(avg_humid, servo_fan, fan_status)
 
+        # Ask the camera's video recorder to save a clip of the fan turning on/off, or the averages leaving the ideal
+        # range (see video_recorder.py)
+        try:
+            if fan_status != previous_fan_status:
+                crab_library.request_video_trigger(f"fan-{fan_status}")
+            was_in_ideal_range = in_ideal_range
+            in_ideal_range = (crab_library.IDEAL_TEMP_LOWER_LIMIT <= avg_temp <= crab_library.IDEAL_TEMP_UPPER_LIMIT and
+                              crab_library.IDEAL_HUMID_LOWER_LIMIT <= avg_humid <= crab_library.IDEAL_HUMID_UPPER_LIMIT)
+            if was_in_ideal_range and not in_ideal_range:
+                crab_library.request_video_trigger("climate")
+        except Exception as e:
+            crab_library.print_log("VIDEO-TRIGGER-ERROR: Issue asking the video recorder for a clip", 0)
+            print(e)
+
         # Temperature and heat_lamp control NOTE: Currently in prototype/offline
         # print("before heat lamp statues: [%s]", heat_lamp_status)
         # Commenting out for the time being until more debugging methods occur
@@ -257,19 +337,37 @@ while True:
 
         # Printing and Log objects
         try:
+            # Sensors without a new reading this loop (failed, or waiting out a backoff) are logged as "err"
+            humidity_1, tempeture_f_1 = sensor_1.log_values()
+            humidity_2, tempeture_f_2 = sensor_2.log_values()
+
             # Just doing manual print-outs for now, can make this dynamic in the future
             crab_library.print_log(
-                f"writing the following: {sensor_1.humidity} {sensor_1.tempeture_f} {sensor_2.humidity} {sensor_2.tempeture_f} {fan_status}",
+                f"writing the following: {humidity_1} {tempeture_f_1} {humidity_2} {tempeture_f_2} {fan_status}",
                 2)
-            log_file.write(str(datetime.today().strftime('%Y-%m-%d-%H:%M:%S'))
-                           + ", " + str(sensor_1.humidity)
-                           + ", " + str(sensor_1.tempeture_f)
-                           + ", " + str(sensor_2.humidity)
-                           + ", " + str(sensor_2.tempeture_f)
-                           + ", " + fan_status
-                           + ", " + heat_lamp_status
-                           + '\n')
+            log_line = log_store.format_line(datetime.today(), humidity_1, tempeture_f_1, humidity_2, tempeture_f_2,
+                                             fan_status, heat_lamp_status)
+
+            # While the spool still has readings, add to the end of it so everything lands in the logs in order
+            if log_file is None or sample_spool.has_pending():
+                sample_spool.add(log_line)
+            else:
+                # Flushed right away, so a USB drive that was pulled shows up here and the line goes in the spool,
+                # rather than being lost from the buffer when the file is closed
+                log_file.write(log_line)
+                log_file.flush()
         except Exception as e:
             crab_library.print_log("DATA-ERROR: Issue writing to log file", 0)
             print(e)
+            try:
+                sample_spool.add(log_line)
+                if log_file is not None:
+                    try:
+                        log_file.close()
+                    except OSError:
+                        pass
+                log_file = None
+            except Exception as e:
+                crab_library.print_log("SPOOL-ERROR: Issue adding reading to the spool", 0)
+                print(e)
 
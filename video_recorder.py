@@ -0,0 +1,186 @@
+"""
+Joel Yuhas
+Raspberry-Pi/Hermit Crab project
+
+-------------------------------------------------------------------------------------
+video_recorder.py
+-------------------------------------------------------------------------------------
+
+Records video all the time, but only keeps the last few seconds of it in memory, and only saves a clip to the USB
+drive when something interesting happens. This replaces the fixed length clips of video_capture() in camera_capture.py,
+which had gaps between each clip.
+
+The camera records H.264 into a circular buffer in memory (PiCameraCircularIO) on VIDEO_SPLITTER_PORT, alongside the
+picture captures. A clip is saved when triggered by:
+    - Motion: the camera's H.264 motion vectors show enough of the frame moving
+    - A climate event: temp_humid_capture.py calls crab_library.request_video_trigger() (fan turning on/off, leaving the
+      ideal range), which puts a file in VIDEO_TRIGGER_DIRECTORY
+    - Manual: putting any file in VIDEO_TRIGGER_DIRECTORY, or sending the camera program SIGUSR1
+
+When triggered, the recording is switched over to a file to catch what happens next, and the last
+VIDEO_PRE_TRIGGER_SECONDS in the buffer are saved. Once VIDEO_POST_TRIGGER_SECONDS pass with no new trigger (or the
+clip reaches VIDEO_MAX_CLIP_SECONDS), the recording is switched back to the buffer and the before and after parts are
+joined into one "clip_<MMSS>_<reason>.h264" in the hour folder. Switching over before saving the buffer means no frames
+are lost between the two parts.
+
+poll() is called every loop of camera_capture.py, it never blocks waiting on the clip.
+
+"""
+import os
+import signal
+import threading
+import time
+import crab_library
+
+from datetime import datetime
+
+
+def make_motion_detector(camera, on_motion):
+    """
+    Creates the motion output for the recording. Only imported here, as it needs numpy.
+
+    :param camera: The PiCamera
+    :param on_motion: Called (from the camera's thread) when motion is seen
+    """
+    import numpy
+    from picamera.array import PiMotionAnalysis
+
+    class MotionDetector(PiMotionAnalysis):
+        def analyse(self, a):
+            magnitude = numpy.sqrt(numpy.square(a['x'].astype(numpy.float32)) +
+                                   numpy.square(a['y'].astype(numpy.float32)))
+            if (magnitude > crab_library.VIDEO_MOTION_MAGNITUDE).sum() > crab_library.VIDEO_MOTION_BLOCKS:
+                on_motion()
+
+    return MotionDetector(camera)
+
+
+class CircularRecorder:
+    def __init__(self, camera, use_motion=True):
+        """
+        :param camera: The PiCamera, already set up
+        :param use_motion: True to trigger clips on motion
+        """
+        self.camera = camera
+        self.use_motion = use_motion
+        self.stream = None
+        # Set from other threads (motion, signal), read by poll()
+        self.trigger_reason = None
+        self.lock = threading.Lock()
+
+        # The clip being saved, None if not saving
+        self.clip_path = None
+        self.after_path = None
+        self.clip_start_time = 0
+        self.clip_end_time = 0
+
+    def start(self):
+        """
+        Starts recording into the circular buffer, and sets up the SIGUSR1 manual trigger
+        """
+        # Only imported here, so the rest of the project can import this module without picamera
+        from picamera import PiCameraCircularIO
+
+        self.stream = PiCameraCircularIO(self.camera, seconds=crab_library.VIDEO_PRE_TRIGGER_SECONDS + 5,
+                                         splitter_port=crab_library.VIDEO_SPLITTER_PORT)
+        motion_output = make_motion_detector(self.camera, lambda: self.trigger("motion")) if self.use_motion else None
+        self.camera.start_recording(self.stream, format='h264', splitter_port=crab_library.VIDEO_SPLITTER_PORT,
+                                    motion_output=motion_output)
+        signal.signal(signal.SIGUSR1, lambda signal_number, frame: self.trigger("manual"))
+        crab_library.VIDEO_TRIGGER_DIRECTORY.mkdir(parents=True, exist_ok=True)
+        crab_library.print_log("Video recorder started", 1)
+
+    def trigger(self, reason):
+        """
+        Asks for a clip to be saved, safe to call from any thread. The clip is started on the next poll().
+
+        :param reason: Short reason for the clip, used in the clip's file name
+        """
+        with self.lock:
+            if self.trigger_reason is None:
+                self.trigger_reason = reason
+
+    def _take_trigger(self):
+        # Trigger files from the other programs (or by hand)
+        for path in sorted(crab_library.VIDEO_TRIGGER_DIRECTORY.iterdir()):
+            self.trigger(path.name.rsplit("-", 1)[0] if "-" in path.name else path.name)
+            path.unlink()
+
+        with self.lock:
+            reason = self.trigger_reason
+            self.trigger_reason = None
+        return reason
+
+    def drop_triggers(self):
+        """
+        Throws away any triggers, used while the USB drive is unavailable so they don't turn into clips of the wrong
+        moment once it is back
+        """
+        reason = self._take_trigger()
+        if reason is not None:
+            crab_library.print_log(f"Video clip not saved, the USB drive is unavailable ({reason})", 1)
+
+    def poll(self, save_directory):
+        """
+        Starts, extends or finishes a clip, depending on the triggers since the last poll
+
+        :param save_directory: The hour folder to save new clips in
+        :return: The path of the clip that was finished, or None
+        """
+        reason = self._take_trigger()
+        now = time.monotonic()
+
+        if self.clip_path is None:
+            if reason is not None:
+                self._start_clip(save_directory, reason, now)
+            return None
+
+        # Any trigger while saving keeps the clip going
+        if reason is not None:
+            self.clip_end_time = min(now + crab_library.VIDEO_POST_TRIGGER_SECONDS,
+                                     self.clip_start_time + crab_library.VIDEO_MAX_CLIP_SECONDS)
+        if now >= self.clip_end_time:
+            return self._finish_clip()
+        return None
+
+    def _start_clip(self, save_directory, reason, now):
+        name = f"clip_{datetime.today().strftime('%M%S')}_{reason}.h264"
+        # With container files (see capture_container.py) the hour folder is only made for the clips
+        save_directory.mkdir(exist_ok=True)
+        self.clip_path = save_directory / name
+        self.after_path = save_directory / ('.after_' + name)
+
+        # Switch the recording over to a file first, then save what's in the buffer, so nothing is missed in between
+        self.camera.split_recording(str(self.after_path), splitter_port=crab_library.VIDEO_SPLITTER_PORT)
+        self.stream.copy_to(str(self.clip_path), seconds=crab_library.VIDEO_PRE_TRIGGER_SECONDS)
+        self.stream.clear()
+
+        self.clip_start_time = now
+        self.clip_end_time = now + crab_library.VIDEO_POST_TRIGGER_SECONDS
+        crab_library.print_log(f"Video clip started: {self.clip_path} ({reason})", 1)
+
+    def _finish_clip(self):
+        self.camera.split_recording(self.stream, splitter_port=crab_library.VIDEO_SPLITTER_PORT)
+
+        # H.264 streams can be joined by just adding one onto the end of the other
+        with open(self.clip_path, "ab") as clip_file, open(self.after_path, "rb") as after_file:
+            while True:
+                data = after_file.read(1024 * 1024)
+                if not data:
+                    break
+                clip_file.write(data)
+        os.remove(self.after_path)
+
+        clip_path = self.clip_path
+        self.clip_path = None
+        self.after_path = None
+        crab_library.print_log(f"Video clip saved: {clip_path}", 1)
+        return clip_path
+
+    def stop(self):
+        """
+        Finishes any clip being saved and stops recording
+        """
+        if self.clip_path is not None:
+            self._finish_clip()
+        self.camera.stop_recording(splitter_port=crab_library.VIDEO_SPLITTER_PORT)